@@ -0,0 +1,180 @@
+"""
+checkpoint.py
+
+Checkpoints of a SnakeGame in a fixed binary layout, written by a background thread
+and restored through mmap (arrays are copied in bulk, nothing is unpickled).
+
+Layout (native byte order, checkpoints stay on the machine that wrote them):
+    header    magic, version, tick, seed, counts of every section (HEADER)
+    rng       state of SnakeGame.rng: 625 uint32 + gauss_next (d, NaN for None)
+    snakes    one SNAKE record per snake
+    points    body points of all snakes, int32 x0, y0, x1, y1, ...
+    ticks     Snake.segment_ticks of all decimated snakes, int32
+    food      FoodStore arrays (xs, ys, colors, radii, values, alive, free-list)
+    chunks    one CHUNK record per materialized chunk
+    strings   snake ids, then resume tokens as (token, snake id) pairs, each H length + utf-8
+
+Github: https://github.com/neilc24/slither24
+Author: Neil (GitHub: neilc24)
+"""
+
+import math
+import mmap
+import os
+import queue
+import struct
+import threading
+from array import array
+
+from snake import Snake
+from snake_game import SnakeGame
+from food_store import FoodStore
+from config import *
+
+CHECKPOINT_MAGIC = b"SLCK"
+CHECKPOINT_VERSION = 2
+HEADER = struct.Struct('=4sHQQIIIIIII') # magic, version, tick, seed, snakes, points, segments, food slots, free slots, chunks, tokens
+RNG_STATE = struct.Struct('=625Id')
+SNAKE = struct.Struct('=IdddddBBBBiiii') # points, length, direction, angle, speed, radius, rgb, decimated, limit_box
+CHUNK = struct.Struct('=iiQ')            # chunk_x, chunk_y, last_active_tick
+STR_LEN = struct.Struct('=H')
+
+def encode_checkpoint(game:SnakeGame, tokens):
+    """ Encode a game (and the resume tokens {token:snake_id}) into the checkpoint layout """
+    snakes = list(game.snakes.items())
+    points = array('i')
+    segment_ticks = array('i')
+    parts = [None, None] # Header and RNG state, filled in below
+    for snake_id, s in snakes:
+        points.extend(c for p in s.positions for c in p)
+        segment_ticks.extend(s.segment_ticks)
+        parts.append(SNAKE.pack(len(s.positions), s.length, s.direction, s.angle, s.speed, s.radius,
+                                *s.color, s.decimated, *s.limit_box))
+    parts.append(points.tobytes())
+    parts.append(segment_ticks.tobytes())
+    parts.extend(game.food.__getstate__())
+    parts.extend(CHUNK.pack(cx, cy, last_active) for (cx, cy), last_active in game.chunks.items())
+    for text in [snake_id for snake_id, s in snakes]+[t for pair in tokens.items() for t in pair]:
+        raw = text.encode()
+        parts.append(STR_LEN.pack(len(raw))+raw)
+    version, internal, gauss_next = game.rng.getstate()
+    parts[0] = HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, game.tick, game.seed, len(snakes),
+                           len(points)//2, len(segment_ticks), len(game.food.alive), len(game.food.free), len(game.chunks), len(tokens))
+    parts[1] = RNG_STATE.pack(*internal, math.nan if gauss_next is None else gauss_next)
+    return b"".join(parts)
+
+def write_checkpoint(path, data):
+    """ Atomically replace the checkpoint file with data """
+    tmp_path = path+".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """ Restore (game, tokens) from a checkpoint file, or return None if there is none """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, tick, seed, n_snakes, n_points, n_segments, n_food, n_free, n_chunks, n_tokens = HEADER.unpack_from(mm, 0)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError(f"{path} is not a checkpoint (version {CHECKPOINT_VERSION})")
+        i = HEADER.size
+        game = SnakeGame(seed)
+        game.tick = tick
+        rng = RNG_STATE.unpack_from(mm, i)
+        game.rng.setstate((3, tuple(rng[:625]), None if math.isnan(rng[625]) else rng[625]))
+        i += RNG_STATE.size
+        records = [SNAKE.unpack_from(mm, i+k*SNAKE.size) for k in range(n_snakes)]
+        i += n_snakes*SNAKE.size
+        points = array('i')
+        points.frombytes(mm[i:i+8*n_points])
+        i += 8*n_points
+        segment_ticks = array('i')
+        segment_ticks.frombytes(mm[i:i+4*n_segments])
+        i += 4*n_segments
+        food_state = []
+        for size in (4*n_food, 4*n_food, 4*n_food, 4*n_food, 4*n_food, n_food, 4*n_free):
+            food_state.append(mm[i:i+size])
+            i += size
+        game.food = FoodStore.__new__(FoodStore)
+        game.food.__setstate__(food_state)
+        for k in range(n_chunks):
+            cx, cy, last_active = CHUNK.unpack_from(mm, i)
+            game.chunks[(cx, cy)] = last_active
+            i += CHUNK.size
+        strings = []
+        for k in range(n_snakes+2*n_tokens):
+            (length,) = STR_LEN.unpack_from(mm, i)
+            strings.append(mm[i+STR_LEN.size:i+STR_LEN.size+length].decode())
+            i += STR_LEN.size+length
+    offset = segment_offset = 0
+    for snake_id, (count, length, direction, angle, speed, radius, r, g, b, decimated, *box) in zip(strings, records):
+        s = Snake.__new__(Snake)
+        s.decimated = bool(decimated)
+        s.positions = list(zip(points[2*offset:2*(offset+count):2], points[2*offset+1:2*(offset+count):2]))
+        n = count-1 if s.decimated else 0
+        s.segment_ticks = segment_ticks[segment_offset:segment_offset+n].tolist()
+        segment_offset += n
+        s.direction, s.angle, s.speed, s.length, s.radius = direction, angle, speed, length, radius
+        s.color, s.limit_box = (r, g, b), tuple(box)
+        game.snakes[snake_id] = s
+        offset += count
+    pairs = strings[n_snakes:]
+    tokens = {pairs[k]: pairs[k+1] for k in range(0, len(pairs), 2)}
+    return game, tokens
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread. The tick thread only hands over a copy of the game;
+    if the previous checkpoint is still being written the new one is skipped.
+    """
+    def __init__ (self, path, *, lock_print):
+        self.path = path
+        self.lock_print = lock_print
+        self.pending = queue.Queue(maxsize=1)
+        # Held while writing, so that the final checkpoint is not overwritten by an older one
+        self.lock_write = threading.Lock()
+        self.closed = False
+        t_writer = threading.Thread(target=self.run)
+        t_writer.daemon = True
+        t_writer.start()
+
+    def __str__ (self):
+        return f"<CheckpointWriter path={self.path}>"
+
+    def submit(self, game_copy, tokens):
+        """ Queue a checkpoint, return False if the writer is still busy """
+        try:
+            self.pending.put_nowait((game_copy, tokens))
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        """ Encode and write the queued checkpoints """
+        while True:
+            game_copy, tokens = self.pending.get()
+            with self.lock_write:
+                if self.closed:
+                    return
+                try:
+                    write_checkpoint(self.path, encode_checkpoint(game_copy, tokens))
+                except OSError as e:
+                    with self.lock_print:
+                        print(f"Unable to write checkpoint. Reason: {e}")
+
+    def close(self, game, tokens):
+        """ Write a last checkpoint of game right away (on the calling thread) and stop writing """
+        with self.lock_write:
+            self.closed = True
+            try:
+                write_checkpoint(self.path, encode_checkpoint(game, tokens))
+            except OSError as e:
+                with self.lock_print:
+                    print(f"Unable to write checkpoint. Reason: {e}")
+                return False
+        return True
@@ -15,59 +15,125 @@ pyinstaller --clean --onefile --name SlitherGrandGalaxy24
 import pygame as pg
 import math
 import socket
+import struct
 import pickle
 import threading
+import time
+import sys
 
 from snake_game import SnakeGame
 from snake_network import SnakeNetwork
+from snake_render import sprite_cache, render_game, FramePresenter
 from config import *
 
 class GameClient(SnakeNetwork):
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(self, host=HOST, port=PORT, *, spectate=None):
         self.server_addr = (host, port)
-        self.game_img = SnakeGame() # A local image of the game that runs on the server
+        # Spectators follow the snake spectate_target ("" for a free camera) and do not play
+        self.spectating = spectate is not None
+        self.spectate_target = spectate or ""
+        self.cam_pos = MAP_CENTER # Last camera position, where a free camera starts
+        self.last_spectate_sent = 0
+        # A local image of the game that runs on the server. The receiver thread decodes
+        # every snapshot into a new instance (back buffer) and publishes it by reassigning
+        # self.game_img, which is atomic, so the render loop never waits on decoding.
+        self.game_img = SnakeGame()
         self.my_id = ""
-        self.lock_game_img = threading.Lock()
+        self.token = None # Resume token, sent when reconnecting
+        self.conn = None  # Current connection to the server
         self.lock_print = threading.Lock()
         self.id_recv_event = threading.Event()
         self.game_img_recv_event = threading.Event()
-        self.stop_event = threading.Event()
+        self.stop_event = threading.Event()      # Game over (died or quit)
+        self.conn_lost_event = threading.Event() # Connection dropped, try to reconnect
+        self.retry_after = None # Seconds to wait before reconnecting, set when the server is full
         self.clock = pg.time.Clock()
+        self.frame_times = {} # Frame time histogram {bucket (ms): count}
 
     def start(self):
         """ Start game """
         # Ask user for server address
         self.input_addr_shell()
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
-            # Connect to server
-            with self.lock_print:
-                print(f"Connecting to {self.server_addr}...")
-            conn.settimeout(RECV_TIMEOUT*2)
-            try:
-                conn.connect(self.server_addr)
-            except Exception as e:
-                with self.lock_print:
-                    print(f"Cannot connect. Reason: {e}")
+        conn = self.connect()
+        if conn is None:
+            return
+        # Wait till received my_id (unless spectating) and the first game_img from server,
+        # connecting again if the server turned us away
+        while not ((self.spectating or self.id_recv_event.is_set()) and self.game_img_recv_event.is_set()):
+            if self.conn_lost_event.wait(0.1):
+                conn.close()
+                conn = self.reconnect()
+                if conn is None:
                     return
-            self.send_passkey(conn, lock_print=self.lock_print)
-            with self.lock_print:
-                print("Connected to server.")
-            # Start a thread to receive data from server
-            t_receive = threading.Thread(target=self.handle_server, args=(conn,))
-            t_receive.daemon = True # Set as a daemon thread
-            t_receive.start()
-            # Wait till received my_id from server
-            self.id_recv_event.wait()
-            # Wait untill receiving first game_img
-            self.game_img_recv_event.wait()
-            screen, sound_channel = my_client.init_window()
-            # Game loop
-            while not self.stop_event.is_set() and self.game_loop(screen, sound_channel, conn):
-                self.clock.tick(FPS)
+        screen, sound_channel = my_client.init_window()
+        presenter = FramePresenter(screen)
+        # Game loop
+        while not self.stop_event.is_set():
+            # The server went away (e.g. restarting from a checkpoint): reconnect and resume
+            if self.conn_lost_event.is_set():
+                conn.close()
+                conn = self.reconnect()
+                if conn is None:
+                    break
+            frame_start = time.perf_counter()
+            loop = self.spectator_loop if self.spectating else self.game_loop
+            if not loop(presenter, sound_channel, conn):
+                break
+            self.record_frame_time((time.perf_counter()-frame_start)*1000)
+            self.clock.tick(FPS)
+        if conn is not None:
+            conn.close()
         with self.lock_print:
             print("-- GAME OVER --")
+            if PRINT_FRAME_TIMES:
+                self.print_frame_times()
         my_client.quit_window()
     
+    def connect(self):
+        """ Connect to server and join (or resume with self.token), return the connection or None """
+        with self.lock_print:
+            print(f"Connecting to {self.server_addr}...")
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(RECV_TIMEOUT*2)
+        try:
+            conn.connect(self.server_addr)
+        except Exception as e:
+            conn.close()
+            with self.lock_print:
+                print(f"Cannot connect. Reason: {e}")
+            return None
+        if self.spectating:
+            self.send_spectate(conn, self.spectate_target, lock_print=self.lock_print)
+        elif self.token is None:
+            self.send_passkey(conn, lock_print=self.lock_print)
+        else:
+            self.send_resume(conn, self.token, lock_print=self.lock_print)
+        with self.lock_print:
+            print("Connected to server.")
+        self.conn = conn
+        self.conn_lost_event.clear()
+        # Start a thread to receive data from server
+        t_receive = threading.Thread(target=self.handle_server, args=(conn,))
+        t_receive.daemon = True # Set as a daemon thread
+        t_receive.start()
+        return conn
+
+    def reconnect(self):
+        """ Try to connect again after the connection was lost, return the connection or None """
+        for attempt in range(1, RECONNECT_ATTEMPTS+1):
+            # Wait as long as the server asked to, if it was full
+            delay = RECONNECT_DELAY if self.retry_after is None else self.retry_after
+            self.retry_after = None
+            with self.lock_print:
+                print(f"Connection lost. Reconnecting in {delay:.1f}s ({attempt}/{RECONNECT_ATTEMPTS})...")
+            time.sleep(delay)
+            if pg.display.get_init():
+                pg.event.pump() # Keep the window responsive
+            conn = self.connect()
+            if conn is not None:
+                return conn
+        return None
+
     def init_window(self):
         """ Initialize music and window display """
         # Initialize pygame
@@ -109,14 +175,36 @@ class GameClient(SnakeNetwork):
             self.server_addr = (self.server_addr[0], int(port))
         return self.server_addr
 
-    def game_loop(self, screen, sound_channel, conn):
+    def record_frame_time(self, frame_time):
+        """ Add the time spent on a frame (in ms, excluding tick sleep) to the histogram """
+        bucket = int(frame_time//FRAME_TIME_BUCKET)*FRAME_TIME_BUCKET
+        self.frame_times[bucket] = self.frame_times.get(bucket, 0) + 1
+
+    def print_frame_times(self):
+        """ Print the frame time histogram """
+        total = sum(self.frame_times.values())
+        if total == 0:
+            return
+        print(f"Frame times ({total} frames):")
+        for bucket in sorted(self.frame_times):
+            count = self.frame_times[bucket]
+            bar = "#"*max(1, round(50*count/total))
+            print(f"{bucket:>4}-{bucket+FRAME_TIME_BUCKET:<4}ms {count:>7} {bar}")
+
+    def game_loop(self, presenter, sound_channel, conn):
         """ Main game loop inside 'while Ture' """
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 return False
 
+        # Hold a reference to the current front buffer for the whole frame,
+        # the receiver thread may publish a new one at any time
+        game_img = self.game_img
+        if not self.my_id in game_img.snakes:
+            return True
+
         # Switch music if speeding up
-        if self.game_img.snakes[self.my_id].speed > SPEED_NORMAL:
+        if game_img.snakes[self.my_id].speed > SPEED_NORMAL:
             pg.mixer.music.pause()
             sound_channel.unpause()
         else:
@@ -130,44 +218,95 @@ class GameClient(SnakeNetwork):
         speed = SPEED_NORMAL if not keys[pg.K_SPACE] else SPEED_FAST
         # Send input to server
         if not self.send_input(conn, direction, speed, lock_print=self.lock_print):
-            return False
+            self.conn_lost_event.set()
+            return True
         
-        # Run game logic locally
-        with self.lock_game_img:
-            self.game_img.update_player(self.my_id, direction, speed)
-            self.game_img.snakes[self.my_id].move()
-
-        # Render
-        screen.fill(BLACK)
-        font = pg.font.Font(None, 36)
-        text = font.render(f"{self.game_img.snakes[self.my_id]}", True, RED)
-        screen.blit(text, (10, 10))
-        pg.draw.line(screen, WHITE, SCREEN_CENTER, mouse_pos, width=1)
-        self.game_img.render(screen=screen, 
-                             head_pos=self.game_img.snakes[self.my_id].head(), 
-                             zf=self.game_img.get_zf(self.my_id))
-        pg.display.flip()
+        # Run game logic locally (only the render thread touches the front buffer)
+        game_img.update_player(self.my_id, direction, speed)
+        game_img.snakes[self.my_id].move()
+
+        # Render the world, then the HUD on top at full resolution
+        head_pos, zf = game_img.snakes[self.my_id].head(), game_img.get_zf(self.my_id)
+        self.cam_pos = head_pos
+        render_game(game_img, screen=presenter.begin_frame(), head_pos=head_pos, zf=zf, dirty=presenter.dirty)
+        presenter.end_world()
+        screen = presenter.screen
+        text = sprite_cache.get_font(36).render(f"{game_img.snakes[self.my_id]}", True, RED)
+        presenter.add_hud(screen.blit(text, (10, 10)))
+        presenter.add_hud(pg.draw.line(screen, WHITE, SCREEN_CENTER, mouse_pos, width=1))
+        presenter.present((game_img.get_cam_center(head_pos, zf), zf))
+
+        return True
+
+    def spectator_loop(self, presenter, sound_channel, conn):
+        """ Game loop of a spectator: follow the target snake, or move a free camera with the arrow keys """
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                return False
+        sound_channel.pause()
+        pg.mixer.music.unpause()
+        # Repeat the request now and then, so the server knows the spectator is still there
+        if time.perf_counter()-self.last_spectate_sent >= SPECTATOR_KEEPALIVE:
+            if not self.send_spectate(conn, self.spectate_target, lock_print=self.lock_print):
+                self.conn_lost_event.set()
+                return True
+            self.last_spectate_sent = time.perf_counter()
+
+        game_img = self.game_img
+        if self.spectate_target in game_img.snakes:
+            # Move the followed snake locally between snapshots, as players do with their own
+            target = game_img.snakes[self.spectate_target]
+            target.move()
+            self.cam_pos, zf = target.head(), game_img.get_zf(self.spectate_target)
+        else:
+            keys = pg.key.get_pressed()
+            dx, dy = keys[pg.K_RIGHT]-keys[pg.K_LEFT], keys[pg.K_DOWN]-keys[pg.K_UP]
+            zf = 1
+            # Keep the camera within the map so that it starts moving back at once
+            self.cam_pos = game_img.get_cam_center((self.cam_pos[0]+dx*SPECTATOR_CAM_SPEED, 
+                                                    self.cam_pos[1]+dy*SPECTATOR_CAM_SPEED), zf)
+
+        # Render the world and the HUD, only the changed rectangles while the camera stands still
+        render_game(game_img, screen=presenter.begin_frame(), head_pos=self.cam_pos, zf=zf, dirty=presenter.dirty)
+        presenter.end_world()
+        caption = f"Spectating {self.spectate_target}" if self.spectate_target else "Spectating (arrow keys to move)"
+        text = sprite_cache.get_text(caption, 36, RED)
+        presenter.add_hud(presenter.screen.blit(text, (10, 10)))
+        presenter.present((game_img.get_cam_center(self.cam_pos, zf), zf))
 
         return True
 
     def handle_server_data(self, raw_data, msg_type):
         """ Handle raw data received from server """
         if msg_type == MSG_TYPE_SNAKEGAME:
-            with self.lock_game_img:
-                self.game_img = pickle.loads(raw_data)
+            # Decode into a back buffer on this thread, then swap the reference
+            back_buffer = pickle.loads(raw_data)
+            self.game_img = back_buffer
             if not self.game_img_recv_event.is_set():
                 with self.lock_print:
-                    print(f"Received first game snapshot={self.game_img}")
+                    print(f"Received first game snapshot={back_buffer}")
                 self.game_img_recv_event.set()
         elif msg_type == MSG_TYPE_SNAKEID:
             self.my_id = raw_data.decode()
             with self.lock_print:
                 print(f"Received id={self.my_id}")
             self.id_recv_event.set()
+        elif msg_type == MSG_TYPE_TOKEN:
+            self.token = raw_data.decode()
+        elif msg_type == MSG_TYPE_SERVER_FULL:
+            (self.retry_after,) = struct.unpack('!f', raw_data)
+            with self.lock_print:
+                print(f"Server is full. Retry after {self.retry_after:.1f}s.")
         elif msg_type == MSG_TYPE_NOTICE:
             with self.lock_print:
                 print("Received message: You died.")
-            self.stop_event.set()
+            if SPECTATE_ON_DEATH:
+                # Keep watching from where the snake died
+                self.spectating = True
+                self.spectate_target = ""
+                self.last_spectate_sent = 0
+            else:
+                self.stop_event.set()
         else:
             with self.lock_print:
                 print("Cannot decode data from server.")
@@ -181,8 +320,14 @@ class GameClient(SnakeNetwork):
                     break
                 raw_data, msg_type = msg
                 self.handle_server_data(raw_data, msg_type)
-        self.stop_event.set()
+        # Only the receiver of the current connection reports it lost
+        if conn is self.conn:
+            self.conn_lost_event.set()
 
 if __name__ == "__main__":
-    my_client = GameClient()
+    # python client.py --spectate [snake_id]
+    spectate = None
+    if len(sys.argv) > 1 and sys.argv[1] == "--spectate":
+        spectate = sys.argv[2] if len(sys.argv) > 2 else ""
+    my_client = GameClient(spectate=spectate)
     my_client.start()
\ No newline at end of file
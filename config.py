@@ -16,15 +16,58 @@ RECV_TIMEOUT = 2
 MSG_TYPE_SNAKEGAME = 11  # A pickled instance of SnakeGame()
 MSG_TYPE_SNAKEID = 12    # A string of snake_id
 MSG_TYPE_NOTICE = 13     # Death notice
+MSG_TYPE_TOKEN = 14      # Resume token for reconnecting to the same snake
+MSG_TYPE_SERVER_FULL = 15 # Join refused, retry after (float, seconds)
 # Messages types (int) from clients to server
 MSG_TYPE_PASSKEY = 21   # User register request
 MSG_TYPE_INPUT = 22      # User input
+MSG_TYPE_RESUME = 23     # Reconnect request (passkey + resume token)
+MSG_TYPE_SPECTATE = 24   # Spectate request (passkey + snake_id to follow, empty for a free camera)
 MAX_PLAYERS = 100
+MAX_HANDSHAKES = 32     # Connections registering at the same time, more are refused
+ADMISSION_RATE = 50     # New connections admitted per second...
+ADMISSION_BURST = 100   # ...and at most this many at once
+ADMISSION_RETRY_JITTER = 2 # Random seconds added to retry-after, to spread reconnect storms
+SERVER_FULL_RETRY = 5   # Retry-after (seconds) when all the player IDs are taken
+JOIN_BATCH_MAX = 20     # Players added to the game per tick
+RECONNECT_ATTEMPTS = 10 # Client retries after losing the connection
+RECONNECT_DELAY = 1     # Seconds between reconnect attempts
+SPECTATE_ON_DEATH = False # Let dead players keep watching as spectators (until they close the window) instead of being disconnected
+SPECTATOR_CAM_SPEED = 20 # Free camera speed (map units per frame)
+SPECTATOR_KEEPALIVE = 1  # Seconds between spectate requests, must be less than RECV_TIMEOUT
 
 BROADCAST_FREQUENCY = 2
 
+# Parallel collision phase (server)
+PARALLEL_COLLISION = False
+COLLISION_WORKERS = 4
+PARALLEL_COLLISION_MIN = 32 # Use the serial path below this many snakes
+
+# Recording (server) and replay: python replay.py <log file>
+RECORD_PATH = None # e.g. "replay.bin" to record every game
+REPLAY_CHECKSUM_INTERVAL = 60 # Ticks between state checksums in the log
+
+# Checkpoints (server): the world is restored from CHECKPOINT_PATH on restart
+CHECKPOINT_PATH = None # e.g. "world.ckpt"
+CHECKPOINT_INTERVAL = 300 # Ticks between checkpoints
+RESUME_GRACE_TICKS = 1800 # Ticks a restored snake waits for its player before it is removed
+RESUME_TOKEN_BYTES = 16
+
 # Window
 FPS = 60
+NUMPY_BATCH_MIN = 64 # Smallest batch of coordinates worth transforming with NumPy
+SPRITE_CACHE_SIZE = 4096 # Maximum number of cached sprites
+SPRITE_RADIUS_STEP = 0.5 # Radius quantization of cached circle sprites
+LOD_SPACING_SCALE_MAX = 1.4 # Spacing of drawn body circles grows with zoom factor up to this scale...
+LOD_SPACING_MAX = 1.5       # ...but stays below this many radii, so the circles always overlap
+LOD_OUTLINE_ZF = 1.5      # Draw snakes as simplified outlines beyond this zoom factor (reached at length ~2000)...
+LOD_OUTLINE_RADIUS = 6    # ...or when body radius on screen is smaller than this (pixels)
+LOD_OUTLINE_SPACING = 3   # Joints of an outline are this many radii apart
+RENDER_SCALE = 1.0      # Render the world at this fraction of the screen resolution (e.g. 0.5 for low-end)
+DIRTY_RECTS = False     # Only update changed rectangles while the camera stands still
+DIRTY_RECTS_MAX = 500   # Update the whole display when more rectangles than this changed
+PRINT_FRAME_TIMES = False # Print a frame time histogram when the client quits (instrumentation)
+FRAME_TIME_BUCKET = 2    # Width of a histogram bucket (ms)
 SCREEN_WIDTH = 1200
 SCREEN_HEIGHT = 800
 SCREEN_CENTER = (SCREEN_WIDTH//2, SCREEN_HEIGHT//2)
@@ -39,6 +82,9 @@ MAP_HEIGHT = 4000
 MAP_CENTER = (MAP_WIDTH//2, MAP_HEIGHT//2)
 
 DIRECTION_INIT = 0 # In degrees
+SPAWN_MARGIN = 300 # Least distance between a new snake and the edge of the map
+SPAWN_CLEARANCE = 300 # Least distance between a new snake and the other snakes...
+SPAWN_ATTEMPTS = 30 # ...tried this many times before spawning in the last point drawn
 LENGTH_MIN = 28
 SNAKE_RADIUS_MIN = 9
 ANGLE_MAX = 6 # Maximum turning angle
@@ -46,12 +92,25 @@ SPEED_NORMAL = 2.4
 SPEED_FAST = 4.8
 SPEEDUP_COST = 0.18 # Cost of length per frame when speeding up
 BODY_INTERVAL = 12.5
+SNAKE_DECIMATED = False # Store only a body joint every BODY_JOINT_TICKS moves instead of a point per tick
+BODY_JOINT_TICKS = 5 # About BODY_INTERVAL apart at normal speed
 
 FOOD_PER_1000x1000 = 150
 FOOD_MIN = round(FOOD_PER_1000x1000*MAP_WIDTH*MAP_HEIGHT/(1000*1000)) # Least amount of food in total
 FOOD_RADIUS_AVE = 5.5 # Average normal food radius
 FOOD_VALUE_AVE = 1.75 # Average normal food value
 
+FOOD_GRID_SIZE = 100 # Cell size of the food spatial index
+
+# Lazy world: food only exists in chunks near the snakes (spectator cameras do not count,
+# a free camera away from every snake sees an empty map)
+LAZY_CHUNKS = False
+WORLD_SEED = None # Set (e.g. 24) to get the same world every game, None for a new one
+CHUNK_SIZE = 1000
+CHUNK_MARGIN = 500 # Chunks this close to the camera view of a snake are materialized
+CHUNK_REFILL_INTERVAL = FPS # Ticks between refilling active chunks and freeing idle ones
+CHUNK_IDLE_TICKS = FPS*30
+
 FOOD_BODY_RADIUS_AVE = SNAKE_RADIUS_MIN+2 # Average food radius made from killed snakes
 FOOD_BODY_VALUE_AVE = FOOD_VALUE_AVE*3 # Average food value made from killed snakes
 
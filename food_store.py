@@ -0,0 +1,179 @@
+"""
+food_store.py
+
+Compact storage for the food on the map.
+
+Github: https://github.com/neilc24/slither24
+Author: Neil (GitHub: neilc24)
+"""
+
+import math
+from array import array
+from bisect import bisect_left, insort
+
+from config import *
+
+class FoodStore:
+    """
+    Food kept as parallel typed arrays (struct of arrays) indexed by integer handles.
+    Removed slots go to a free-list and are reused, so handles stay stable while a food item lives.
+    The spatial grid keeps the handles of each cell in a sorted array, which is also used to find taken positions.
+    Only the arrays and the free-list are serialized, the grid is rebuilt on load.
+    """
+    def __init__ (self):
+        self.xs = array('i')
+        self.ys = array('i')
+        self.colors = array('I') # Packed 0xRRGGBB
+        self.radii = array('f')
+        self.values = array('f')
+        self.alive = array('B')
+        self.free = [] # Handles of empty slots
+        self.rebuild_index()
+
+    @staticmethod
+    def cell_of(pos):
+        """ Return the grid cell of a position """
+        return (pos[0]//FOOD_GRID_SIZE, pos[1]//FOOD_GRID_SIZE)
+
+    def __len__ (self):
+        return self.count
+
+    def __contains__ (self, pos):
+        return self.handle_at(pos) is not None
+
+    def __str__ (self):
+        return f"<FoodStore food={len(self)}, slots={len(self.alive)}>"
+
+    def __getstate__ (self):
+        return (self.xs.tobytes(), self.ys.tobytes(), self.colors.tobytes(),
+                self.radii.tobytes(), self.values.tobytes(), self.alive.tobytes(),
+                array('I', self.free).tobytes())
+
+    def __setstate__ (self, state):
+        self.xs, self.ys = array('i', state[0]), array('i', state[1])
+        self.colors, self.radii = array('I', state[2]), array('f', state[3])
+        self.values, self.alive = array('f', state[4]), array('B', state[5])
+        # Keep the order of the free-list so that handles are reused exactly as before
+        self.free = array('I', state[6]).tolist()
+        self.rebuild_index()
+
+    def __deepcopy__ (self, memo):
+        # Copying arrays is a memcpy, much cheaper than going through __getstate__
+        copied = FoodStore.__new__(FoodStore)
+        copied.xs, copied.ys, copied.colors = array('i', self.xs), array('i', self.ys), array('I', self.colors)
+        copied.radii, copied.values, copied.alive = array('f', self.radii), array('f', self.values), array('B', self.alive)
+        copied.free = self.free.copy()
+        copied.count = self.count
+        copied.grid = {cell: array('I', handles) for cell, handles in self.grid.items()}
+        return copied
+
+    def rebuild_index(self):
+        """ Rebuild self.grid = {(cell_x, cell_y):array of handles} """
+        self.grid = {}
+        self.count = 0
+        for h in range(len(self.alive)):
+            if self.alive[h]:
+                # Handles come in increasing order, so the cells end up sorted
+                self.grid.setdefault(self.cell_of((self.xs[h], self.ys[h])), array('I')).append(h)
+                self.count += 1
+
+    def handle_at(self, pos):
+        """ Return the handle of the food at pos, or None """
+        xs, ys = self.xs, self.ys
+        for h in self.grid.get(self.cell_of(pos), ()):
+            if xs[h] == pos[0] and ys[h] == pos[1]:
+                return h
+        return None
+
+    def add(self, pos, color, radius, value):
+        """ Add a food item and return its handle, or None if the position is taken """
+        if self.handle_at(pos) is not None:
+            return None
+        packed = (color[0] << 16) | (color[1] << 8) | color[2]
+        if self.free:
+            h = self.free.pop()
+            self.xs[h], self.ys[h] = pos
+            self.colors[h], self.radii[h], self.values[h] = packed, radius, value
+            self.alive[h] = 1
+        else:
+            h = len(self.alive)
+            self.xs.append(pos[0])
+            self.ys.append(pos[1])
+            self.colors.append(packed)
+            self.radii.append(radius)
+            self.values.append(value)
+            self.alive.append(1)
+        insort(self.grid.setdefault(self.cell_of(pos), array('I')), h)
+        self.count += 1
+        return h
+
+    def add_many(self, positions, colors, radii, values):
+        """
+        Add a batch of food items (parallel lists). Positions that are taken, or repeated
+        within the batch, are skipped. Return the indices (into the batch) of the items added.
+        """
+        keys = {}
+        for i, pos in enumerate(positions):
+            k = (pos[0] << 32) + pos[1]
+            if not k in keys and self.handle_at(pos) is None:
+                keys[k] = i
+        added = list(keys.values())
+        # Fill the free slots first, then grow the arrays in one go
+        n_reuse = min(len(added), len(self.free))
+        reused = [self.free.pop() for _ in range(n_reuse)]
+        for h, i in zip(reused, added):
+            self.xs[h], self.ys[h] = positions[i]
+            c = colors[i]
+            self.colors[h] = (c[0] << 16) | (c[1] << 8) | c[2]
+            self.radii[h], self.values[h] = radii[i], values[i]
+            self.alive[h] = 1
+        appended = added[n_reuse:]
+        start = len(self.alive)
+        self.xs.extend(positions[i][0] for i in appended)
+        self.ys.extend(positions[i][1] for i in appended)
+        self.colors.extend((colors[i][0] << 16) | (colors[i][1] << 8) | colors[i][2] for i in appended)
+        self.radii.extend(radii[i] for i in appended)
+        self.values.extend(values[i] for i in appended)
+        self.alive.extend(bytes([1])*len(appended))
+        grid = self.grid
+        for h in reused+list(range(start, start+len(appended))):
+            insort(grid.setdefault(self.cell_of((self.xs[h], self.ys[h])), array('I')), h)
+        self.count += len(added)
+        return added
+
+    def remove(self, h):
+        """ Remove a food item and return its value """
+        cell = self.cell_of((self.xs[h], self.ys[h]))
+        handles = self.grid[cell]
+        del handles[bisect_left(handles, h)]
+        if not handles:
+            del self.grid[cell]
+        self.alive[h] = 0
+        self.count -= 1
+        self.free.append(h)
+        return self.values[h]
+
+    def handles(self):
+        """ Return handles of all the food """
+        return [h for h in range(len(self.alive)) if self.alive[h]]
+
+    def position(self, h):
+        """ Return the position of a food item """
+        return (self.xs[h], self.ys[h])
+
+    def color(self, h):
+        """ Return the RGB color of a food item """
+        c = self.colors[h]
+        return ((c >> 16) & 255, (c >> 8) & 255, c & 255)
+
+    def query_rect(self, x1, x2, y1, y2):
+        """ Return handles of food inside the rectangle (left, right, up, down) """
+        xs, ys = self.xs, self.ys
+        found = []
+        for cx in range(math.floor(x1)//FOOD_GRID_SIZE, math.floor(x2)//FOOD_GRID_SIZE+1):
+            for cy in range(math.floor(y1)//FOOD_GRID_SIZE, math.floor(y2)//FOOD_GRID_SIZE+1):
+                cell = self.grid.get((cx, cy))
+                if cell is None:
+                    continue
+                found.extend(h for h in cell if x1 <= xs[h] <= x2 and y1 <= ys[h] <= y2)
+        return found
@@ -16,6 +16,7 @@ import sys
 
 from snake_game import SnakeGame
 from snake_network import SnakeNetwork
+from snake_render import sprite_cache, render_game, FramePresenter
 from config import *
 
 # The only snake controlled by huamn existing in the offline game
@@ -39,6 +40,7 @@ sound_channel01.pause()
 pg.display.set_icon(pg.image.load(SnakeNetwork().get_abs_path('assets/icon.png')))
 pg.display.set_caption(WINDOW_CAPTION)
 screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+presenter = FramePresenter(screen)
 
 clock = pg.time.Clock()
 
@@ -74,9 +76,9 @@ while running and (MY_SNAKE_ID in mygame.snakes):
                             pg.mixer.music.stop()
                             pg.quit()
                             sys.exit()
-                    screen.fill(BLACK)
-                    mygame.render(screen=screen, head_pos=head_pos, zf=zf)
-                    pg.display.flip()
+                    render_game(mygame, screen=presenter.begin_frame(), head_pos=head_pos, zf=zf, dirty=presenter.dirty)
+                    presenter.end_world()
+                    presenter.present((head_pos, zf))
                     clock.tick(FPS)
                     
     keys, mouse_pos = pg.key.get_pressed(), pg.mouse.get_pos()
@@ -86,15 +88,13 @@ while running and (MY_SNAKE_ID in mygame.snakes):
     direction = math.degrees(math.atan2(-dy, dx)) # In pygame up and down are reversed
     speed = SPEED_NORMAL if not keys[pg.K_SPACE] else SPEED_FAST
 
-    screen.fill(BLACK)
-    font = pg.font.Font(None, 36)
-    text = font.render(f"{mygame.snakes[MY_SNAKE_ID]}", True, RED)
-    screen.blit(text, (10, 10))
-    pg.draw.line(screen, WHITE, SCREEN_CENTER, mouse_pos, width=1)
-
-    mygame.render(screen, mygame.snakes[MY_SNAKE_ID].head(), 
-                  mygame.get_zf(MY_SNAKE_ID), p_names=False, p_box=True)
-    pg.display.flip()
+    head_pos, zf = mygame.snakes[MY_SNAKE_ID].head(), mygame.get_zf(MY_SNAKE_ID)
+    render_game(mygame, presenter.begin_frame(), head_pos, zf, p_names=False, p_box=True, dirty=presenter.dirty)
+    presenter.end_world()
+    text = sprite_cache.get_font(36).render(f"{mygame.snakes[MY_SNAKE_ID]}", True, RED)
+    presenter.add_hud(screen.blit(text, (10, 10)))
+    presenter.add_hud(pg.draw.line(screen, WHITE, SCREEN_CENTER, mouse_pos, width=1))
+    presenter.present((head_pos, zf))
 
     mygame.update_player(MY_SNAKE_ID, direction, speed)
     mygame.update_player("DEBUG") # DEBUG
@@ -0,0 +1,169 @@
+"""
+parallel_collision.py
+
+Parallel collision phase: heads are tested against bodies in a pool of worker processes,
+reading the snakes from a block of shared memory.
+
+Github: https://github.com/neilc24/slither24
+Author: Neil (GitHub: neilc24)
+"""
+
+import math
+import multiprocessing
+from array import array
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from snake import segment_dist2
+from config import *
+
+# Layout of the shared block:
+# [n_snakes, n_points] + n_snakes records of RECORD_SIZE (float64),
+# then body points as int32 x0, y0, x1, y1, ...
+# Record: offset (in points), count, radius, decimated, left, right, up, down, head_x, head_y
+RECORD_SIZE = 10
+HEADER_SIZE = 2
+
+# Shared blocks attached by this worker process: {name:SharedMemory}
+_attached = {}
+
+def _attach(name):
+    """ Attach (once) to a shared block created by the main process """
+    if not name in _attached:
+        for old in _attached.values():
+            old.close()
+        _attached.clear()
+        # Workers share the resource tracker of the main process, which owns and unlinks the block
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return _attached[name]
+
+def _ready():
+    """ Worker: do nothing, used to start the workers """
+    return True
+
+def detect_range(name, first, last):
+    """
+    Worker: return [(i, hits)] for the snakes in [first, last) whose head hits something,
+    hits being [-1] for the edge of the map, otherwise the indices of all the other snakes hit
+    """
+    shm = _attach(name)
+    header = shm.buf[:8*HEADER_SIZE].cast('d')
+    n, n_points = int(header[0]), int(header[1])
+    header.release()
+    records_end = 8*(HEADER_SIZE+n*RECORD_SIZE)
+    records = shm.buf[8*HEADER_SIZE:records_end].cast('d').tolist()
+    records = [records[i*RECORD_SIZE:(i+1)*RECORD_SIZE] for i in range(n)]
+    points = shm.buf[records_end:records_end+8*n_points].cast('i')
+    try:
+        found = []
+        for i in range(first, last):
+            ra, px, py = records[i][2], records[i][8], records[i][9]
+            # Collision with the edge of the map
+            if px <= ra or py <= ra or px >= MAP_WIDTH-ra or py >= MAP_HEIGHT-ra:
+                found.append((i, [-1]))
+                continue
+            # Collision with other snakes (same arithmetic as Snake.hits)
+            hits = []
+            for j in range(n):
+                offset, count, rb, decimated, left, right, up, down = records[j][:8]
+                r = ra+rb
+                if j == i or not (px >= left-r and px <= right+r and py >= up-r and py <= down+r):
+                    continue
+                if _hits(points, int(offset), int(count), decimated, px, py, r*r):
+                    hits.append(j)
+            if hits:
+                found.append((i, hits))
+        return found
+    finally:
+        points.release()
+
+def _hits(points, offset, count, decimated, px, py, rr):
+    """ Worker: decide if (px, py) is within sqrt(rr) of a body stored in points """
+    start, end = 2*offset, 2*(offset+count)
+    if not decimated:
+        for k in range(start, end, 2):
+            x, y = points[k], points[k+1]
+            if (px-x)*(px-x)+(py-y)*(py-y) <= rr:
+                return True
+        return False
+    x1, y1 = points[start], points[start+1]
+    if (px-x1)*(px-x1)+(py-y1)*(py-y1) <= rr:
+        return True
+    for k in range(start+2, end, 2):
+        x2, y2 = points[k], points[k+1]
+        if segment_dist2(px, py, x1, y1, x2, y2) <= rr:
+            return True
+        x1, y1 = x2, y2
+    return False
+
+class ParallelCollider:
+    """
+    Detect collisions of a SnakeGame in a persistent process pool.
+    Bodies and heads are copied into shared memory once per tick, workers return the hits of their heads
+    which are merged in the order of game.snakes, the same as SnakeGame.detect_collisions().
+    """
+    def __init__ (self, workers=COLLISION_WORKERS, min_snakes=PARALLEL_COLLISION_MIN):
+        self.workers = workers
+        self.min_snakes = min_snakes
+        # Forking a process that runs threads (the server) can deadlock on locks held by other
+        # threads, so workers are started from a clean process instead
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self.shm = None
+        # Start the workers now (before the server starts its threads) rather than on the first tick
+        for future in [self.pool.submit(_ready) for _ in range(workers)]:
+            future.result()
+
+    def __str__ (self):
+        return f"<ParallelCollider workers={self.workers}>"
+
+    def close(self):
+        """ Stop the workers and free the shared memory """
+        self.pool.shutdown()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def reserve(self, size):
+        """ Make sure the shared block can hold size bytes, growing it if needed """
+        if self.shm is not None and self.shm.size >= size:
+            return
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+        # Grow geometrically so that reallocations are rare
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size*3//2, 1 << 16))
+
+    def pack(self, game):
+        """ Write the snakes of game into the shared block """
+        snakes = list(game.snakes.values())
+        n_points = sum(len(s.positions) for s in snakes)
+        records = array('d', [len(snakes), n_points])
+        offset = 0
+        for s in snakes:
+            records.extend((offset, len(s.positions), s.radius, s.decimated, *s.limit_box, *s.head()))
+            offset += len(s.positions)
+        points = array('i', chain.from_iterable(chain.from_iterable(s.positions for s in snakes)))
+        records_size = 8*len(records)
+        self.reserve(records_size+4*len(points))
+        self.shm.buf[:records_size] = records.tobytes()
+        self.shm.buf[records_size:records_size+4*len(points)] = points.tobytes()
+
+    def detect_collisions(self, game):
+        """ Return {snake_id:[IDs of the snakes hit, or None for the edge]} like SnakeGame.detect_collisions() """
+        snake_ids = list(game.snakes)
+        if len(snake_ids) < self.min_snakes:
+            return game.detect_collisions()
+        self.pack(game)
+        chunk = math.ceil(len(snake_ids)/self.workers)
+        futures = [self.pool.submit(detect_range, self.shm.name, first, min(first+chunk, len(snake_ids)))
+                   for first in range(0, len(snake_ids), chunk)]
+        hits = {}
+        # Ranges are in order and each one is sorted, so the snakes stay in the order of game.snakes
+        for future in futures:
+            for i, found in future.result():
+                hits[snake_ids[i]] = [None if j < 0 else snake_ids[j] for j in found]
+        return hits
@@ -0,0 +1,151 @@
+"""
+replay.py
+
+Record the inputs of a game to a compact append-only binary log, and replay it headless.
+
+The log starts with a header (magic, version, seed) followed by records, each a one-byte type:
+    J  join    snake index (H), id (H length + utf-8), position (dd), color (BBB)
+    S  spawn   same as join, but the position was drawn by SnakeGame.spawn_point()
+    L  leave   snake index (H)
+    I  input   snake index (H), direction (d), speed (d)
+    T  tick    update_game() was called
+    C  check   tick (Q), CRC32 of the game state (I), every REPLAY_CHECKSUM_INTERVAL ticks
+Snake indices are assigned in order of joining, so ids are only written once.
+
+Usage: python replay.py <log file>
+
+Github: https://github.com/neilc24/slither24
+Author: Neil (GitHub: neilc24)
+"""
+
+import struct
+import sys
+import time
+import zlib
+
+from snake_game import SnakeGame
+from config import *
+
+LOG_MAGIC = b"SL24"
+LOG_VERSION = 2
+HEADER = struct.Struct('!4sHQ')
+REC_JOIN, REC_SPAWN, REC_LEAVE, REC_INPUT, REC_TICK, REC_CHECK = b"J", b"S", b"L", b"I", b"T", b"C"
+JOIN = struct.Struct('!HddBBB')
+LEAVE = struct.Struct('!H')
+INPUT = struct.Struct('!Hdd')
+CHECK = struct.Struct('!QI')
+ID_LEN = struct.Struct('!H')
+
+def game_checksum(game:SnakeGame):
+    """ Return a CRC32 of everything in the game state that a replay must reproduce """
+    crc = zlib.crc32(struct.pack('!Q', game.tick))
+    for snake_id, s in game.snakes.items():
+        crc = zlib.crc32(snake_id.encode(), crc)
+        crc = zlib.crc32(struct.pack('!dddd', s.length, s.angle, s.direction, s.speed), crc)
+        crc = zlib.crc32(repr(s.positions).encode(), crc)
+    for data in game.food.__getstate__():
+        crc = zlib.crc32(data, crc)
+    return crc
+
+class GameRecorder:
+    """ Append joins, leaves, inputs and ticks of a SnakeGame to a log file """
+    def __init__ (self, path, seed):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(LOG_MAGIC, LOG_VERSION, seed))
+        self.indices = {} # {snake_id:index}
+
+    def __str__ (self):
+        return f"<GameRecorder file={self.file.name}, snakes={len(self.indices)}>"
+
+    def close(self):
+        self.file.close()
+
+    def record_join(self, snake_id, position, color, spawned=False):
+        """ Record SnakeGame.add_player(), spawned if position came from SnakeGame.spawn_point() """
+        self.indices[snake_id] = len(self.indices)
+        raw_id = snake_id.encode()
+        self.file.write((REC_SPAWN if spawned else REC_JOIN) + JOIN.pack(self.indices[snake_id], *position, *color)
+                        + ID_LEN.pack(len(raw_id)) + raw_id)
+
+    def record_leave(self, snake_id):
+        """ Record SnakeGame.kill_snake() called from outside the game loop """
+        self.file.write(REC_LEAVE + LEAVE.pack(self.indices[snake_id]))
+
+    def record_input(self, snake_id, direction, speed):
+        """ Record SnakeGame.update_player() """
+        self.file.write(REC_INPUT + INPUT.pack(self.indices[snake_id], direction, speed))
+
+    def record_tick(self, game:SnakeGame):
+        """ Record SnakeGame.update_game() (call it after the update) """
+        self.file.write(REC_TICK)
+        if game.tick % REPLAY_CHECKSUM_INTERVAL == 0:
+            self.file.write(REC_CHECK + CHECK.pack(game.tick, game_checksum(game)))
+            self.file.flush()
+
+def replay(path):
+    """
+    Rebuild the game recorded in a log as fast as possible.
+    Return (game, ticks, divergences), divergences being the ticks whose checksum did not match.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, seed = HEADER.unpack_from(data)
+    if magic != LOG_MAGIC or version != LOG_VERSION:
+        raise ValueError(f"{path} is not a replay log (version {LOG_VERSION})")
+    game = SnakeGame(seed)
+    ids = []
+    divergences = []
+    i = HEADER.size
+    # A truncated last record (e.g. the server was killed) ends the replay
+    while i < len(data):
+        rec, i = data[i:i+1], i+1
+        if rec == REC_TICK:
+            game.update_game()
+        elif rec == REC_INPUT:
+            if i+INPUT.size > len(data):
+                break
+            index, direction, speed = INPUT.unpack_from(data, i)
+            i += INPUT.size
+            game.update_player(ids[index], direction, speed)
+        elif rec in (REC_JOIN, REC_SPAWN):
+            if i+JOIN.size+ID_LEN.size > len(data):
+                break
+            index, x, y, r, g, b = JOIN.unpack_from(data, i)
+            (id_len,) = ID_LEN.unpack_from(data, i+JOIN.size)
+            i += JOIN.size+ID_LEN.size
+            snake_id = data[i:i+id_len].decode()
+            i += id_len
+            ids.append(snake_id)
+            if rec == REC_SPAWN:
+                # Draw the spawn point again so the game RNG goes on like it did when recording
+                game.spawn_point()
+            game.add_player(snake_id, (round(x), round(y)), (r, g, b))
+        elif rec == REC_LEAVE:
+            if i+LEAVE.size > len(data):
+                break
+            (index,) = LEAVE.unpack_from(data, i)
+            i += LEAVE.size
+            game.kill_snake(ids[index])
+        elif rec == REC_CHECK:
+            if i+CHECK.size > len(data):
+                break
+            tick, crc = CHECK.unpack_from(data, i)
+            i += CHECK.size
+            if game_checksum(game) != crc:
+                divergences.append(tick)
+        else:
+            raise ValueError(f"Corrupted replay log at byte {i-1}")
+    return game, game.tick, divergences
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python replay.py <log file>")
+        sys.exit(1)
+    start = time.perf_counter()
+    game, ticks, divergences = replay(sys.argv[1])
+    duration = time.perf_counter()-start
+    print(f"Replayed {ticks} ticks in {duration:.2f}s ({ticks/max(duration, 1e-9):.0f} ticks/s). Final state: {game}")
+    if divergences:
+        print(f"Diverged at ticks: {divergences[:10]}")
+        sys.exit(2)
+    print("All checksums match.")
@@ -7,31 +7,133 @@ Author: Neil (GitHub: neilc24)
 pyinstaller --clean --onefile --name Slither24Server server.py
 """
 
-import pygame as pg
 import socket
 import struct
 import threading
 from concurrent.futures import ThreadPoolExecutor
 import copy
+import secrets
+import time
+import random
+import multiprocessing
+from collections import deque
 
 from snake_game import SnakeGame
 from snake_network import SnakeNetwork
+from parallel_collision import ParallelCollider
+from replay import GameRecorder
+from checkpoint import load_checkpoint, CheckpointWriter
 from config import *
 
+class TickClock:
+    """ Limit a loop to a number of ticks per second (like pygame.time.Clock.tick(), without pygame) """
+    def __init__ (self):
+        self.next_tick = time.perf_counter()
+
+    def tick(self, fps):
+        """ Sleep until the next tick is due """
+        self.next_tick += 1/fps
+        delay = self.next_tick-time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Running late: start counting from now instead of trying to catch up
+            self.next_tick = time.perf_counter()
+
+class TokenBucket:
+    """ Allow events at rate per second on average, in bursts of at most burst """
+    def __init__ (self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.perf_counter()
+
+    def take(self):
+        """ Take a token, return 0 if there was one, otherwise the seconds until the next one """
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens+(now-self.last)*self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1-self.tokens)/self.rate
+
 class GameServer(SnakeNetwork):
     def __init__(self, host="", port=PORT):
         self.server_addr = (host, port)
         self.mygame = SnakeGame()
         self.players = {}
-        # Deadlock prevention: lock_mygame > lock_players > lock_print
+        # Spectators {player:snake_id to follow, or None for a free camera}, guarded by lock_players
+        self.spectators = {}
+        # Resume tokens {token:snake_id} and restored snakes waiting for their player
+        # {snake_id:deadline tick}, both guarded by lock_mygame
+        self.tokens = {}
+        self.unclaimed = {}
+        # Numbers free for new IDs, guarded by lock_mygame
+        self.free_ids = deque(range(1, MAX_PLAYERS))
+        # Admission: connections are refused beyond MAX_HANDSHAKES concurrent handshakes
+        # or ADMISSION_RATE per second, joins wait in pending_joins for the next tick
+        self.handshakes = threading.BoundedSemaphore(MAX_HANDSHAKES)
+        self.admission = TokenBucket(ADMISSION_RATE, ADMISSION_BURST)
+        self.pending_joins = []
+        # Deadlock prevention: lock_mygame > lock_players > lock_joins > lock_print
         self.lock_mygame = threading.Lock()
         self.lock_players = threading.Lock()
+        self.lock_joins = threading.Lock()
         self.lock_print = threading.Lock()
-        self.clock = pg.time.Clock()
+        self.clock = TickClock()
+        # Process pool for the collision phase
+        self.collider = ParallelCollider() if PARALLEL_COLLISION else None
+        # Restore the world of the previous run and checkpoint it periodically
+        restored = self.restore_checkpoint() if CHECKPOINT_PATH else False
+        self.checkpointer = CheckpointWriter(CHECKPOINT_PATH, lock_print=self.lock_print) if CHECKPOINT_PATH else None
+        # Log of everything that changes the game, for replaying (all calls hold lock_mygame).
+        # A restored game cannot be replayed from its seed, so it is not recorded.
+        self.recorder = GameRecorder(RECORD_PATH, self.mygame.seed) if RECORD_PATH and not restored else None
+
+    def restore_checkpoint(self):
+        """ Restore the game and resume tokens from CHECKPOINT_PATH, return True if restored """
+        start = time.perf_counter()
+        try:
+            restored = load_checkpoint(CHECKPOINT_PATH)
+        except (ValueError, struct.error) as e:
+            with self.lock_print:
+                print(f"Unable to restore checkpoint. Reason: {e}")
+            return False
+        if restored is None:
+            return False
+        self.mygame, self.tokens = restored
+        deadline = self.mygame.tick+RESUME_GRACE_TICKS
+        self.unclaimed = {snake_id: deadline for snake_id in self.mygame.snakes}
+        # IDs of restored snakes stay taken
+        taken = {self.id_number(snake_id) for snake_id in self.mygame.snakes}
+        self.free_ids = deque(i for i in self.free_ids if not i in taken)
+        with self.lock_print:
+            print(f"Restored {self.mygame} from {CHECKPOINT_PATH} in {(time.perf_counter()-start)*1000:.1f}ms")
+        return True
+
+    def stop(self):
+        """ Save a final checkpoint, close the replay log, release the collision workers and their shared memory """
+        with self.lock_mygame:
+            # Resumed snakes continue from the moment of shutdown, not from the last periodic checkpoint
+            if self.checkpointer is not None:
+                if self.checkpointer.close(self.mygame, self.tokens):
+                    with self.lock_print:
+                        print(f"Final checkpoint written at tick {self.mygame.tick}.")
+                self.checkpointer = None
+            # The log is only flushed at checksum records, the inputs since the last one would be lost
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+            if self.collider is not None:
+                self.collider.close()
+                self.collider = None
 
     def start(self):
         """ Start server """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            # Allow rebinding right away when restarting, despite connections in TIME_WAIT
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
                 server.bind(self.server_addr)
             except Exception as e:
@@ -41,7 +143,7 @@ class GameServer(SnakeNetwork):
 
             server.listen()
             with self.lock_print:
-                print(f"Server listening on {self.server_addr}...")
+                print(f"Server listening on {self.server_addr}... World seed={self.mygame.seed}")
 
             # Start a new thread to run game logic and broadcast
             t_game = threading.Thread(target=self.run_game)
@@ -50,32 +152,107 @@ class GameServer(SnakeNetwork):
 
             # Loop: accepting new clients
             while True:
-                # Print a snapshot of the current game
                 new_client = server.accept()
+                # Refuse the client right away if the server cannot take them now
+                retry_after = self.admit()
+                if retry_after > 0:
+                    self.send_server_full(new_client[0], retry_after, lock_print=self.lock_print)
+                    new_client[0].close()
+                    continue
                 t_client = threading.Thread(target=self.handle_client, args=(new_client,))
                 t_client.start()
                 with self.lock_print:
                     print(f"Connected to {new_client[1]}. Connections={threading.active_count()-2}")
-                with self.lock_mygame, self.lock_print:
-                    print(self.mygame)
 
-    def register_player(self, player):
-        """ Register a new player in the game and return their ID """
-        new_id = self.generate_id(player[1][0])
-        # Add player to players
-        with self.lock_players:
-            self.players[player] = new_id
-        # Add player to mygame
-        with self.lock_mygame:
-            self.mygame.add_player(new_id, color=self.mygame.randcolor(100, 255))
+    def admit(self):
+        """
+        Decide if a new connection may start its handshake (then a handshake slot is taken).
+        Return 0 if admitted, otherwise the seconds after which the client should retry.
+        """
+        if not self.handshakes.acquire(blocking=False):
+            return 1/ADMISSION_RATE+random.uniform(0, ADMISSION_RETRY_JITTER)
+        wait = self.admission.take()
+        if wait > 0:
+            self.handshakes.release()
+            # Spread the retries of a crowd over the jitter window
+            return wait+random.uniform(0, ADMISSION_RETRY_JITTER)
+        return 0
+
+    def register_player(self, player, token=None):
+        """
+        Register a new player in the game (or hand back a restored snake) and return their ID.
+        The join is applied by the game thread at the next tick, this waits for it.
+        """
+        join = {"player": player, "token": token, "snake_id": None, "resumed": False, "done": threading.Event()}
+        with self.lock_joins:
+            self.pending_joins.append(join)
+        join["done"].wait()
+        new_id, token = join["snake_id"], join["token"]
+        if new_id is None:
+            # No free ID: the server is full
+            self.send_server_full(player[0], SERVER_FULL_RETRY+random.uniform(0, ADMISSION_RETRY_JITTER),
+                                  lock_print=self.lock_print)
+            return None
         with self.lock_print:
-            print(f"New player added. ID={new_id}")
-        # Send ID back to player
-        if not self.send_id(player[0], new_id, lock_print=self.lock_print):
+            print(f"Player resumed. ID={new_id}" if join["resumed"] else f"New player added. ID={new_id}")
+        # Send ID and resume token back to player
+        if not (self.send_id(player[0], new_id, lock_print=self.lock_print)
+                and self.send_token(player[0], token, lock_print=self.lock_print)):
             self.remove_player(player)
             return None
         return new_id
 
+    def apply_joins(self):
+        """ Add a batch of waiting players to the game (call while holding lock_mygame) """
+        with self.lock_joins:
+            joins = self.pending_joins[:JOIN_BATCH_MAX]
+            del self.pending_joins[:JOIN_BATCH_MAX]
+        for join in joins:
+            # A valid resume token claims the restored snake it was issued for
+            snake_id = self.tokens.get(join["token"])
+            if snake_id in self.unclaimed and snake_id in self.mygame.snakes:
+                del self.unclaimed[snake_id]
+                join["resumed"] = True
+            else:
+                snake_id = self.generate_id(join["player"][1][0])
+                if snake_id is None:
+                    continue
+                join["token"] = secrets.token_hex(RESUME_TOKEN_BYTES)
+                color = self.mygame.randcolor(100, 255)
+                # Players of the same batch are already in the game, so they get spawned apart too
+                position = self.mygame.spawn_point()
+                self.mygame.add_player(snake_id, position, color)
+                self.tokens[join["token"]] = snake_id
+                if self.recorder is not None:
+                    self.recorder.record_join(snake_id, position, color, spawned=True)
+            join["snake_id"] = snake_id
+        with self.lock_players:
+            for join in joins:
+                if join["snake_id"] is not None:
+                    self.players[join["player"]] = join["snake_id"]
+        # Wake up the handler threads
+        for join in joins:
+            join["done"].set()
+        if joins:
+            with self.lock_print:
+                print(f"{len(joins)} joins applied. {self.mygame}")
+
+    def register_spectator(self, player, target=None):
+        """ Add a spectator following target (a snake ID, or None for a free camera) """
+        with self.lock_players:
+            self.spectators[player] = target
+        with self.lock_print:
+            print(f"New spectator added. Target={target}")
+
+    def make_spectator(self, player):
+        """ Turn a player whose snake died into a spectator (call while holding lock_players) """
+        dead_id = self.players.pop(player)
+        self.spectators[player] = None
+        # If the notice cannot be sent the next broadcast removes the spectator
+        self.send_death_notice(player[0], lock_print=self.lock_print)
+        with self.lock_print:
+            print(f"Player {dead_id} is now spectating.")
+
     def remove_player(self, player, holding_lock_mygame=False, holding_lock_players=False, *, reason=None):
         """ Remove a player from the game """
         dead_id = None
@@ -88,6 +265,7 @@ class GameServer(SnakeNetwork):
         if player in self.players:
             dead_id = self.players[player]
             del self.players[player]
+        self.spectators.pop(player, None)
         if not holding_lock_players:
             self.lock_players.release()
         # Remove player from self.mygame
@@ -95,6 +273,9 @@ class GameServer(SnakeNetwork):
             self.lock_mygame.acquire()
         if dead_id in self.mygame.snakes:
             self.mygame.kill_snake(dead_id)
+            if self.recorder is not None:
+                self.recorder.record_leave(dead_id)
+            self.forget_snake(dead_id)
         if not holding_lock_mygame:
             self.lock_mygame.release()
         # Print
@@ -105,18 +286,61 @@ class GameServer(SnakeNetwork):
                 else:
                     print(f"Player {dead_id} removed. Reason: {reason}")
 
+    def forget_snake(self, snake_id):
+        """ Drop the resume tokens and free the ID of a snake that is gone (call while holding lock_mygame) """
+        for token in [t for t, i in self.tokens.items() if i == snake_id]:
+            del self.tokens[token]
+        self.free_ids.append(self.id_number(snake_id))
+
+    def expire_unclaimed(self):
+        """ Remove restored snakes that died or whose player did not come back in time (call while holding lock_mygame) """
+        for snake_id, deadline in list(self.unclaimed.items()):
+            if not snake_id in self.mygame.snakes:
+                # Already forgotten by run_game()
+                reason = "Died."
+            elif deadline <= self.mygame.tick:
+                reason = "Not resumed."
+                self.mygame.kill_snake(snake_id)
+                self.forget_snake(snake_id)
+            else:
+                continue
+            del self.unclaimed[snake_id]
+            with self.lock_print:
+                print(f"Restored snake {snake_id} removed. Reason: {reason}")
+
+    def save_checkpoint(self):
+        """ Hand a copy of the game over to the checkpoint writer (call while holding lock_mygame) """
+        # Only the copy happens on the game thread, encoding and writing are done by the writer thread
+        if not self.checkpointer.submit(copy.deepcopy(self.mygame), dict(self.tokens)):
+            with self.lock_print:
+                print("Checkpoint skipped. Reason: Previous checkpoint still being written.")
+
     def run_game(self):
         """ Run the game logic and broadcast the game state """
         i = 0
         while True:
             with self.lock_mygame:
-                death_records = self.mygame.update_game()
+                # Players join between ticks, in batches
+                if self.pending_joins:
+                    self.apply_joins()
+                death_records = self.mygame.update_game(self.collider)
+                if self.recorder is not None:
+                    self.recorder.record_tick(self.mygame)
+                for snake_id in death_records:
+                    self.forget_snake(snake_id)
+                if self.unclaimed:
+                    self.expire_unclaimed()
+                if self.checkpointer is not None and self.mygame.tick % CHECKPOINT_INTERVAL == 0:
+                    self.save_checkpoint()
             if len(death_records) > 0:
                 with self.lock_players:
-                    # If a player died remove them from {players}
+                    # If a player died remove them from {players} (or let them watch)
                     for player in list(self.players):
                         if self.players[player] in death_records:
-                            self.remove_player(player, False, True, reason="Died.")
+                            if SPECTATE_ON_DEATH:
+                                self.make_spectator(player)
+                            else:
+                                self.remove_player(player, False, True, reason="Died.")
             # Broadcast current game state to every player
             if i == BROADCAST_FREQUENCY:
                 self.broadcast_game()
@@ -126,18 +350,28 @@ class GameServer(SnakeNetwork):
             self.clock.tick(FPS)
 
     def broadcast_game(self):
-        """ Broadcast the game state to every player """
+        """ Broadcast the game state to every player and spectator """
         # To decrease lock holding time, create copies
         with self.lock_mygame:
             game_snapshot = copy.deepcopy(self.mygame)
         with self.lock_players:
-            copy_players = self.players.copy()
+            # {player:snake_id the camera follows}, a player follows their own snake
+            viewers = self.players.copy()
+            viewers.update(self.spectators)
+        # Encode one frame per followed snake, shared by everyone watching it.
+        # Free cameras (and spectators of a snake that is gone) get the whole game.
+        frames = {}
+        for target in set(viewers.values()):
+            if target in game_snapshot.snakes:
+                frames[target] = self.encode_snapshot(self.get_modified_snapshot(game_snapshot, target))
+        if len(frames) < len(set(viewers.values())):
+            full_frame = self.encode_snapshot(game_snapshot)
         # Using threadpool
         with ThreadPoolExecutor(max_workers=MAX_PLAYERS//2+1) as executor:
             futures = []
-            for player in copy_players:
-                futures.append(((executor.submit(self.send_game_snapshot, player[0], 
-                                self.get_modified_snapshot(game_snapshot, copy_players[player]), 
+            for player, target in viewers.items():
+                futures.append(((executor.submit(self.send_raw_snapshot, player[0], 
+                                frames[target] if target in frames else full_frame, 
                                 lock_print=self.lock_print)), player))
             # Remove disconnected players
             for future in futures:
@@ -148,24 +382,36 @@ class GameServer(SnakeNetwork):
     def get_modified_snapshot(self, snapshot:SnakeGame, my_snake_id):
         """ Return a "personalized" snapshot of the game """
         snapshot_copy = copy.deepcopy(snapshot)
+        # Calculate the position of the center of the camera on the map
+        zf = snapshot_copy.get_zf(my_snake_id)
+        cam_center = snapshot_copy.get_cam_center(snapshot_copy.snakes[my_snake_id].head(), zf)
         for snake_id in list(snapshot_copy.snakes):
-            # Calculate the position of the center of the camera on the map
-            zf = snapshot_copy.get_zf(my_snake_id)
-            cam_center = snapshot_copy.get_cam_center(snapshot_copy.snakes[my_snake_id].head(), zf)
             if not snapshot_copy.snake_is_on_screen(snake_id, cam_center, zf):
                 del snapshot_copy.snakes[snake_id]
         return snapshot_copy
 
-    def handle_client_msg(self, snake_id, raw_msg):
+    def handle_client_msg(self, player, raw_msg):
         """ Handle raw data received from a client """
         raw_data, msg_type = raw_msg
         if msg_type == MSG_TYPE_INPUT:
             direction, speed = struct.unpack('ff', raw_data)
             speed = round(speed, 4)
+            # Look the snake up for every input, a dead player's ID may be given to someone else
+            with self.lock_players:
+                snake_id = self.players.get(player)
+            if snake_id is None:
+                return
             with self.lock_mygame:
                 if snake_id in self.mygame.snakes:
                     self.mygame.update_player(snake_id, direction, speed)
-        elif msg_type == MSG_TYPE_PASSKEY:
+                    if self.recorder is not None:
+                        self.recorder.record_input(snake_id, direction, speed)
+        elif msg_type == MSG_TYPE_SPECTATE:
+            # A spectator switching to another snake (or to the free camera)
+            with self.lock_players:
+                if player in self.spectators:
+                    self.spectators[player] = self.get_request_payload(raw_data) or None
+        elif msg_type in (MSG_TYPE_PASSKEY, MSG_TYPE_RESUME):
             pass #
         else:
             with self.lock_print:
@@ -173,36 +419,67 @@ class GameServer(SnakeNetwork):
     
     def is_passkey(self, raw_msg):
         raw_data, msg_type = raw_msg
+        if msg_type in (MSG_TYPE_RESUME, MSG_TYPE_SPECTATE):
+            return raw_data.startswith(PASSKEY.encode('utf-8'))
         return msg_type == MSG_TYPE_PASSKEY and raw_data.decode('utf-8') == PASSKEY
 
+    def get_request_payload(self, raw_data):
+        """ Return what follows the passkey in a resume or spectate request """
+        return raw_data[len(PASSKEY.encode('utf-8')):].decode('utf-8', errors='replace')
+
+    def get_resume_token(self, raw_msg):
+        """ Return the resume token of a resume request, or None """
+        raw_data, msg_type = raw_msg
+        if msg_type != MSG_TYPE_RESUME:
+            return None
+        return self.get_request_payload(raw_data)
+
     def handle_client(self, player):
         """ Register client and receive messages"""
         with player[0] as conn:
-            # Receive and recognize passkey
-            msg = self.recv_msg(conn, lock_print=self.lock_print)
-            if msg is None or not self.is_passkey(msg):
-                with self.lock_print:
-                    print(f"Invalid passkey from {player[1]}")
+            # The handshake slot was taken by admit()
+            try:
+                registered = self.handshake(player)
+            finally:
+                self.handshakes.release()
+            if not registered:
                 return
-            # Register player
-            client_id = self.register_player(player)
             # Message receiving loop
             while True:
                 raw_msg = self.recv_msg(conn, lock_print=self.lock_print)
                 if raw_msg is None:
                     break
-                self.handle_client_msg(client_id, raw_msg)
+                self.handle_client_msg(player, raw_msg)
             # Remove player in the end
             self.remove_player(player, False, False, reason="Disconnected while receiving msg.")
 
+    def handshake(self, player):
+        """ Receive the passkey and register the client, return False if they were turned away """
+        msg = self.recv_msg(player[0], lock_print=self.lock_print)
+        if msg is None or not self.is_passkey(msg):
+            with self.lock_print:
+                print(f"Invalid passkey from {player[1]}")
+            return False
+        # Register player (or spectator, who does not join the game)
+        if msg[1] == MSG_TYPE_SPECTATE:
+            self.register_spectator(player, self.get_request_payload(msg[0]) or None)
+            return True
+        return self.register_player(player, self.get_resume_token(msg)) is not None
+
     def generate_id(self, ip="unknown"):
-        """ Generate an ID for a new player """
-        with self.lock_mygame:
-            for i in range(1, MAX_PLAYERS):
-                if not f"{ip}_{i}" in self.mygame.snakes:
-                    return f"{ip}_{i}"
-        return None
+        """ Generate an ID for a new player from the pool of free numbers (call while holding lock_mygame) """
+        if not self.free_ids:
+            return None
+        return f"{ip}_{self.free_ids.popleft()}"
+
+    def id_number(self, snake_id):
+        """ Return the number an ID was generated from """
+        return int(snake_id.rsplit("_", 1)[1])
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Needed by the collision workers of a frozen (PyInstaller) server
     my_server = GameServer()
-    my_server.start()
\ No newline at end of file
+    try:
+        my_server.start()
+    finally:
+        my_server.stop()
\ No newline at end of file
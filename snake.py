@@ -4,14 +4,28 @@ Github: https://github.com/neilc24/slither24
 """
 
 import math
+import random
 
 from config import *
 
+def segment_dist2(px, py, x1, y1, x2, y2):
+    """ Return the squared distance from point (px, py) to the segment (x1, y1)-(x2, y2) """
+    dx, dy = x2-x1, y2-y1
+    seg = dx*dx+dy*dy
+    t = 0 if seg == 0 else max(0, min(1, ((px-x1)*dx+(py-y1)*dy)/seg))
+    cx, cy = x1+t*dx-px, y1+t*dy-py
+    return cx*cx+cy*cy
+
 class Snake:
     def __init__ (self, head_pos, color, *, 
                   direction=DIRECTION_INIT, speed=SPEED_NORMAL, 
-                  length=LENGTH_MIN, radius=SNAKE_RADIUS_MIN):
+                  length=LENGTH_MIN, radius=SNAKE_RADIUS_MIN, decimated=SNAKE_DECIMATED):
+        # Decimated snakes only keep a body joint every BODY_JOINT_TICKS moves (plus the head),
+        # otherwise there is one position per tick
+        self.decimated = decimated
         self.positions = [head_pos]
+        # Decimated: moves covered by each segment between two positions (tail first)
+        self.segment_ticks = []
         self.direction = direction  # Direction from user
         self.angle = self.direction # Actual direction
         self.speed = speed
@@ -28,6 +42,44 @@ class Snake:
         """ Return the position of the head """
         return self.positions[-1]
 
+    def max_points(self):
+        """ Return how many points (one per tick) the body may keep for the current length """
+        return math.floor(self.length)
+
+    def body_value(self):
+        """ Return the actual body length on the map (in ticks) """
+        if self.decimated:
+            return sum(self.segment_ticks)+1
+        return len(self.positions)
+
+    def random_body_points(self, n, rng=random):
+        """ Return n random points on the body """
+        if not self.decimated or len(self.positions) < 2:
+            return rng.choices(self.positions, k=n)
+        # Pick a random point on a random segment between two joints
+        segments = rng.choices(range(len(self.positions)-1), k=n)
+        points = []
+        for i in segments:
+            (x1, y1), (x2, y2), t = self.positions[i], self.positions[i+1], rng.random()
+            points.append((x1+(x2-x1)*t, y1+(y2-y1)*t))
+        return points
+
+    def hits(self, pos, r):
+        """ Decide if a point is closer than r to the body """
+        px, py = pos
+        rr = r*r
+        if not self.decimated:
+            return any((px-x)*(px-x)+(py-y)*(py-y) <= rr for x, y in self.positions)
+        # Distance to each segment between two joints (capsule test)
+        x1, y1 = self.positions[0]
+        if (px-x1)*(px-x1)+(py-y1)*(py-y1) <= rr:
+            return True
+        for x2, y2 in self.positions[1:]:
+            if segment_dist2(px, py, x1, y1, x2, y2) <= rr:
+                return True
+            x1, y1 = x2, y2
+        return False
+
     def update_radius(self):
         """ Update self.radius based on self.length """
         self.radius = SNAKE_RADIUS_MIN*math.pow(self.length/LENGTH_MIN, 0.125) * math.log(self.length, LENGTH_MIN)
@@ -40,6 +92,27 @@ class Snake:
         self.limit_box = (left, right, up, down)
         return self.limit_box
 
+    def trim_tail(self):
+        """
+        Decimated: cut the tail so that the body covers as many moves as a full body of the same length
+        (max_points()-1), moving the last joint back along its segment
+        """
+        excess = sum(self.segment_ticks)-(self.max_points()-1)
+        # Drop whole segments first
+        drop = 0
+        while drop < len(self.segment_ticks)-1 and excess >= self.segment_ticks[drop]:
+            excess -= self.segment_ticks[drop]
+            drop += 1
+        if drop > 0:
+            del self.positions[:drop]
+            del self.segment_ticks[:drop]
+        if excess > 0:
+            ticks = self.segment_ticks[0]
+            self.segment_ticks[0] = max(0, ticks-excess)
+            keep = self.segment_ticks[0]/ticks
+            (x0, y0), (x1, y1) = self.positions[0], self.positions[1]
+            self.positions[0] = (round(x1+(x0-x1)*keep), round(y1+(y0-y1)*keep))
+
     def move(self):
         """ Move the snake forward """
         def aformat(a):
@@ -73,9 +146,22 @@ class Snake:
         p = list(self.head())
         p[0] += round(math.cos(math.radians(self.angle)) * self.speed)
         p[1] -= round(math.sin(math.radians(self.angle)) * self.speed) # In pygame up and down are reversed
-        self.positions.append(tuple(p))
-        while(len(self.positions) > self.length):
-            self.positions = self.positions[1:]
+        p = tuple(p)
+        if not self.decimated:
+            self.positions.append(p)
+            excess = len(self.positions)-self.max_points()
+            if excess > 0:
+                del self.positions[:excess]
+        elif self.segment_ticks and self.segment_ticks[-1] < BODY_JOINT_TICKS:
+            # Still on the partial segment at the head: move the head only
+            self.positions[-1] = p
+            self.segment_ticks[-1] += 1
+            self.trim_tail()
+        else:
+            # The old head becomes a joint
+            self.positions.append(p)
+            self.segment_ticks.append(1)
+            self.trim_tail()
 
         self.update_radius()
         self.update_limit_box()
\ No newline at end of file
@@ -7,19 +7,48 @@ Github: https://github.com/neilc24/slither24
 Author: Neil (GitHub: neilc24)
 """
 
-import pygame as pg
+import copy
 import math
 import random
+import secrets
 
 from snake import Snake
+from food_store import FoodStore
 from config import *
      
 class SnakeGame:
-    def __init__ (self):
+    def __init__ (self, seed=None):
         # self.snakes = {Snake()}
         self.snakes = {}
-        # self.food = {pos:{"color":GREEN, "radius":5, "value":1.0}}
-        self.food = {}
+        self.food = FoodStore()
+        # A new world every game, unless a seed is given (replays) or fixed with WORLD_SEED
+        if seed is None:
+            seed = WORLD_SEED if WORLD_SEED is not None else secrets.randbits(63)
+        self.seed = seed
+        # Every random choice that changes the game state goes through self.rng,
+        # so that a game can be replayed from its seed and inputs
+        self.rng = random.Random(seed)
+        self.tick = 0
+        # Materialized chunks of the world (LAZY_CHUNKS): self.chunks = {(chunk_x, chunk_y):last_active_tick}
+        self.chunks = {}
+
+    def __getstate__ (self):
+        # The RNG state (~2.5 KB) is not sent with snapshots
+        state = self.__dict__.copy()
+        del state["rng"]
+        return state
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        self.rng = random.Random(self.seed)
+
+    def __deepcopy__ (self, memo):
+        # Unlike a snapshot, a copy keeps the RNG state and goes on exactly like the original
+        copied = SnakeGame.__new__(SnakeGame)
+        memo[id(self)] = copied
+        for name, value in self.__dict__.items():
+            setattr(copied, name, copy.deepcopy(value, memo))
+        return copied
 
     def __str__ (self):
         return f"<SnakeGame snakes={len(self.snakes)}, food={len(self.food)}>"
@@ -45,82 +74,151 @@ class SnakeGame:
             color = self.randcolor(100)
         self.snakes[snake_id] = Snake(position, color)
 
+    def spawn_point(self, rng=None):
+        """ Return a random point away from the edges of the map and from all the snakes """
+        rng = rng or self.rng
+        for _ in range(SPAWN_ATTEMPTS):
+            pos = (rng.randint(SPAWN_MARGIN, MAP_WIDTH-SPAWN_MARGIN), rng.randint(SPAWN_MARGIN, MAP_HEIGHT-SPAWN_MARGIN))
+            if not any(self.is_near(snake, pos, SPAWN_CLEARANCE+snake.radius) for snake in self.snakes.values()):
+                break
+        return pos
+
+    def is_near(self, snake, pos, r):
+        """ Decide if a point is closer than r to the body of a snake """
+        box = snake.limit_box
+        if pos[0] < box[0]-r or pos[0] > box[1]+r or pos[1] < box[2]-r or pos[1] > box[3]+r:
+            return False
+        return snake.hits(pos, r)
+
     def distance2p(self, p1, p2):
         """ Return distance between two points on a 2d map """
-        vec1 = pg.math.Vector2(p1[0], p1[1])
-        vec2 = pg.math.Vector2(p2[0], p2[1])
-        return vec1.distance_to(vec2)
+        return math.dist(p1, p2)
     
+    def random_uniforms(self, n, low, high, rng=None):
+        """ Return a list of n random floats in [low, high) """
+        rand = (rng or self.rng).random
+        return [low+(high-low)*rand() for _ in range(n)]
+
+    def spawn_food(self, n, rect=(0, MAP_WIDTH, 0, MAP_HEIGHT), rng=None):
+        """
+        Scatter a batch of n random food inside rect (left, right, up, down).
+        Return the number actually added.
+        """
+        rng = rng or self.rng
+        xs = rng.choices(range(rect[0], rect[1]+1), k=n)
+        ys = rng.choices(range(rect[2], rect[3]+1), k=n)
+        rgb = rng.choices(range(256), k=3*n)
+        colors = [tuple(rgb[i:i+3]) for i in range(0, 3*n, 3)]
+        radii = self.random_uniforms(n, FOOD_RADIUS_AVE*3/4, FOOD_RADIUS_AVE*5/4, rng)
+        values = self.random_uniforms(n, max(0, FOOD_VALUE_AVE/2), FOOD_VALUE_AVE*3/2, rng)
+        return len(self.food.add_many(list(zip(xs, ys)), colors, radii, values))
+
+    def spawn_body_food(self, snake, tot_val):
+        """ Turn a body into a batch of food worth tot_val in total """
+        spread = 1
+        while tot_val > 0:
+            n = math.ceil(tot_val/FOOD_BODY_VALUE_AVE)+1
+            values = self.random_uniforms(n, max(0, FOOD_BODY_VALUE_AVE/2), FOOD_BODY_VALUE_AVE*3/2)
+            # Cap the values so that they add up to (at most) tot_val
+            acc = 0
+            for i in range(n):
+                if acc+values[i] >= tot_val:
+                    values[i] = tot_val-acc
+                    n = i+1
+                    del values[n:]
+                    break
+                acc += values[i]
+            jx, jy = self.random_uniforms(n, -spread/2, spread/2), self.random_uniforms(n, -spread/2, spread/2)
+            positions = [(round(x+dx), round(y+dy)) 
+                         for (x, y), dx, dy in zip(snake.random_body_points(n, self.rng), jx, jy)]
+            r, g, b = snake.color
+            shades = self.rng.choices(range(-10, 41), k=3*n)
+            colors = [(max(0, min(255, r+dr)), max(0, min(255, g+dg)), max(0, min(255, b+db))) 
+                      for dr, dg, db in zip(shades[0::3], shades[1::3], shades[2::3])]
+            radii = self.random_uniforms(n, max(0, FOOD_BODY_RADIUS_AVE*3/4), FOOD_BODY_RADIUS_AVE*5/4)
+            # Items whose position was taken are dropped and their value goes to the next batch,
+            # scattered wider if nothing could be placed
+            added = self.food.add_many(positions, colors, radii, values)
+            for i in added:
+                tot_val -= values[i]
+            spread = 1 if added else spread+1
+
     def kill_snake(self, snake_id):
         """ Kill a snake and turn its body into food """
         if not snake_id in self.snakes:
             return
         
-        # Using len(.positions) instead of .length to get actual body length on the map
-        tot_val = len(self.snakes[snake_id].positions)
-        # Turning its body into food
-        while tot_val > 0:
-            pos = self.vibrate_pos(random.choice(self.snakes[snake_id].positions))
-            if pos in self.food:
-                continue
-            color = self.vibrate_color(self.snakes[snake_id].color, -10, 40)
-            radius = random.uniform(max(0, FOOD_BODY_RADIUS_AVE*3/4), FOOD_BODY_RADIUS_AVE*5/4)
-            value = min(tot_val, random.uniform(max(0, FOOD_BODY_VALUE_AVE/2), FOOD_BODY_VALUE_AVE*3/2))
-            self.food[pos] = {
-                "color": color, 
-                "radius": radius, 
-                "value": value
-            }
-            tot_val -= value
-
+        # Using .body_value() instead of .length to get actual body length on the map
+        self.spawn_body_food(self.snakes[snake_id], self.snakes[snake_id].body_value())
         del self.snakes[snake_id]
 
-    def handle_collision(self, snake_id):
+    def detect_collision(self, snake_id):
         """
-        Handle collision between snake head and other objects.
-        Return True when snake killed, else return False.
+        Return what the head of a snake hits: [None] for the edge of the map,
+        otherwise the IDs of all the other snakes it hits (empty if none)
         """
-        def is_in_box(box, pos, r=0):
-            """ Determin if a point is closer than r to a limit_box """
-            return (pos[0]>=box[0]-r and pos[0]<=box[1]+r and pos[1]>=box[2]-r and pos[1]<=box[3]+r)
-        
-        if not snake_id in self.snakes:
-            return True
-
         ra = self.snakes[snake_id].radius
         head_pos = self.snakes[snake_id].head()
         # Collision with the edge of the map
         if head_pos[0] <= ra or head_pos[1] <= ra or head_pos[0] >= MAP_WIDTH-ra or head_pos[1] >= MAP_HEIGHT-ra:
-            self.kill_snake(snake_id)
-            return True
+            return [None]
 
         # Collision with other snakes
-        for snake in self.snakes.values():
-            if snake == self.snakes[snake_id] or not is_in_box(snake.limit_box, head_pos, ra+snake.radius):
-                continue
-            for p in snake.positions:
-                if self.distance2p(head_pos, p) <= ra+snake.radius:
-                    self.kill_snake(snake_id)
-                    return True
+        return [other_id for other_id, snake in self.snakes.items()
+                if other_id != snake_id and self.is_near(snake, head_pos, ra+snake.radius)]
+
+    def detect_collisions(self):
+        """ Return {snake_id:detect_collision(snake_id)} of the snakes that hit something, in the order of self.snakes """
+        hits = {}
+        for snake_id in self.snakes:
+            colliders = self.detect_collision(snake_id)
+            if colliders:
+                hits[snake_id] = colliders
+        return hits
+
+    def resolve_collisions(self, hits):
+        """
+        Return the IDs of the snakes killed by the hits of detect_collisions(), in the order of self.snakes.
+        Like snakes handled one after another: a head survives when all the snakes it hits were killed before it
+        (in a head-on collision the first snake dies and the other one lives).
+        """
+        killed = []
+        dead = set()
+        for snake_id, colliders in hits.items():
+            if any(other_id is None or not other_id in dead for other_id in colliders):
+                killed.append(snake_id)
+                dead.add(snake_id)
+        return killed
 
-        # "Collision" with food
+    def eat_food(self, snake_id):
+        """ Let a snake eat the food around its head """
+        ra = self.snakes[snake_id].radius
+        head_pos = self.snakes[snake_id].head()
         f_range = int(ra+FOOD_RADIUS_AVE)
-        for x in range(head_pos[0]-f_range, head_pos[0]+f_range):
-            for y in range(head_pos[1]-f_range, head_pos[1]+f_range):
-                if (x, y) in self.food:
-                    self.snakes[snake_id].length += self.food[(x, y)]["value"]
-                    del self.food[(x, y)]
-
-        return False
-
-    def update_game(self):
-        """ Move the snakes and adjust food on the map. Return the IDs of killed snakes"""
-        death_records = []
-        self.update_food()
-        for snake_id in list(self.snakes):
-            if self.handle_collision(snake_id):
-                death_records.append(snake_id)
-                continue
+        for h in self.food.query_rect(head_pos[0]-f_range, head_pos[0]+f_range-1, 
+                                      head_pos[1]-f_range, head_pos[1]+f_range-1):
+            self.snakes[snake_id].length += self.food.remove(h)
+
+    def update_game(self, collider=None):
+        """
+        Move the snakes and adjust food on the map. Return the IDs of killed snakes.
+        Collisions are all detected against the state at the start of the tick (by collider, e.g.
+        a ParallelCollider, if given) and then resolved in a fixed order, so any collider gives the same result.
+        """
+        self.tick += 1
+        if LAZY_CHUNKS:
+            self.update_chunks()
+        else:
+            self.update_food()
+        if collider is None:
+            hits = self.detect_collisions()
+        else:
+            hits = collider.detect_collisions(self)
+        death_records = self.resolve_collisions(hits)
+        for snake_id in death_records:
+            self.kill_snake(snake_id)
+        for snake_id in self.snakes:
+            self.eat_food(snake_id)
             self.snakes[snake_id].move()
         return death_records
 
@@ -138,22 +236,65 @@ class SnakeGame:
         """ Adjust the amount of food on the map """
         # Not enough food
         while len(self.food) < amount:
-            pos = (random.randint(0, MAP_WIDTH), random.randint(0, MAP_HEIGHT))
-            if pos in self.food.keys():
-                continue
-            color = self.randcolor()
-            radius = random.uniform(FOOD_RADIUS_AVE*3/4, FOOD_RADIUS_AVE*5/4)
-            value = random.uniform(max(0, FOOD_VALUE_AVE/2), FOOD_VALUE_AVE*3/2)
-            self.food[pos] = {
-                "color": color, 
-                "radius": radius, 
-                "value": value
-            }
+            self.spawn_food(amount-len(self.food))
         # Too much food (2x)
         #while len(self.food) > amount*2:
-            #fpos = random.choice(list(self.food.keys()))
-            #del self.food[fpos]
+            #h = self.rng.choice(self.food.handles())
+            #self.food.remove(h)
     
+    def get_chunk_rect(self, chunk):
+        """ Return the area of a chunk on the map as (left, right, up, down) """
+        x1, y1 = chunk[0]*CHUNK_SIZE, chunk[1]*CHUNK_SIZE
+        # The last row and column of chunks reach the edges of the map
+        x2 = MAP_WIDTH if chunk[0] == (MAP_WIDTH-1)//CHUNK_SIZE else x1+CHUNK_SIZE-1
+        y2 = MAP_HEIGHT if chunk[1] == (MAP_HEIGHT-1)//CHUNK_SIZE else y1+CHUNK_SIZE-1
+        return (x1, x2, y1, y2)
+
+    def get_chunk_food(self, rect):
+        """ Return the amount of food a chunk should have """
+        return round(FOOD_PER_1000x1000*(rect[1]-rect[0]+1)*(rect[3]-rect[2]+1)/(1000*1000))
+
+    def chunks_in_rect(self, x1, x2, y1, y2):
+        """ Return the chunks that overlap a rectangle (left, right, up, down) of the map """
+        cx1, cx2 = max(0, math.floor(x1)//CHUNK_SIZE), min((MAP_WIDTH-1)//CHUNK_SIZE, math.floor(x2)//CHUNK_SIZE)
+        cy1, cy2 = max(0, math.floor(y1)//CHUNK_SIZE), min((MAP_HEIGHT-1)//CHUNK_SIZE, math.floor(y2)//CHUNK_SIZE)
+        return [(cx, cy) for cx in range(cx1, cx2+1) for cy in range(cy1, cy2+1)]
+
+    def materialize_chunk(self, chunk):
+        """ Generate the food of a chunk, the same every time for a given world seed """
+        rng = random.Random(f"{self.seed}:{chunk[0]}:{chunk[1]}")
+        rect = self.get_chunk_rect(chunk)
+        self.spawn_food(self.get_chunk_food(rect), rect, rng)
+
+    def free_chunk(self, chunk):
+        """ Remove all the food inside a chunk """
+        for h in self.food.query_rect(*self.get_chunk_rect(chunk)):
+            self.food.remove(h)
+        del self.chunks[chunk]
+
+    def update_chunks(self):
+        """
+        Keep food only in the chunks near the camera view of a snake.
+        Chunks are materialized when first needed, refilled, and freed after CHUNK_IDLE_TICKS.
+        Only snakes materialize chunks (they are part of the game state, so a replay does the same).
+        """
+        for s_id, s in self.snakes.items():
+            cam_center, zf = s.head(), self.get_zf(s_id)
+            for chunk in self.chunks_in_rect(*self.get_cam_rect(cam_center, zf, CHUNK_MARGIN)):
+                if not chunk in self.chunks:
+                    self.materialize_chunk(chunk)
+                self.chunks[chunk] = self.tick
+        if self.tick % CHUNK_REFILL_INTERVAL != 0:
+            return
+        for chunk, last_active in list(self.chunks.items()):
+            if self.tick-last_active > CHUNK_IDLE_TICKS:
+                self.free_chunk(chunk)
+                continue
+            rect = self.get_chunk_rect(chunk)
+            deficit = self.get_chunk_food(rect)-len(self.food.query_rect(*rect))
+            if deficit > 0:
+                self.spawn_food(deficit, rect)
+
     def get_zf(self, snake_id):
         """ Calculate camera zoom factor (zf) based on snake radius """
         if not snake_id in self.snakes:
@@ -166,75 +307,21 @@ class SnakeGame:
         y = max(SCREEN_HEIGHT*zf/2, min(MAP_HEIGHT-(SCREEN_HEIGHT*zf/2), head_pos[1]))
         return (x, y)
     
-    def get_position(self, pos, cam_center, zf):
-        """ Get screen coordinates based on map coordinates """
-        return (round(SCREEN_WIDTH/2-(cam_center[0]-pos[0])/zf), 
-                round(SCREEN_HEIGHT/2-(cam_center[1]-pos[1])/zf))
+    def get_position(self, pos, cam_center, zf, scale=1):
+        """ Get screen coordinates based on map coordinates (scale: render resolution / screen) """
+        return (round(scale*(SCREEN_WIDTH/2-(cam_center[0]-pos[0])/zf)), 
+                round(scale*(SCREEN_HEIGHT/2-(cam_center[1]-pos[1])/zf)))
     
+    def get_cam_rect(self, cam_center, zf, margin=0):
+        """ Return the area of the map seen by the camera as (left, right, up, down) """
+        half_w, half_h = SCREEN_WIDTH*zf/2+margin, SCREEN_HEIGHT*zf/2+margin
+        return (cam_center[0]-half_w, cam_center[0]+half_w, cam_center[1]-half_h, cam_center[1]+half_h)
+
     def invert_get_position(self, pos, cam_center, zf):
         """ Get map coordinates based on screen coordinates """
         return (round(cam_center[0]+(pos[0]-SCREEN_WIDTH/2)*zf), 
                 round(cam_center[1]+(pos[1]-SCREEN_HEIGHT/2)*zf))
 
-    def render(self, screen, head_pos, zf, *, p_names=True, p_box=False):
-        """
-        Render the map, the head of the given snake placed at the center.
-        Camera zooms out when the snake gets bigger.
-        """
-        # Get screen distances baded on map distances
-        get_distance = lambda d: (d/zf)
-
-        # Decide if a dot is in the screen
-        is_in_screen = lambda pos: (pos[0] >= 0 and pos[1] >= 0 and pos[0] <= SCREEN_WIDTH and pos[1] <= SCREEN_HEIGHT)
-
-        ccx, ccy = self.get_cam_center(head_pos, zf)
-        # Render food
-        for fpos in self.food:
-            pos = self.get_position(fpos, (ccx, ccy), zf)
-            if is_in_screen(pos):
-                pg.draw.circle(screen, self.food[fpos]["color"], pos, self.food[fpos]["radius"], 0)
-
-        # Render snakes
-        for s in self.snakes.values():
-            pos_v = (-1e5, -1e5) # Last visible position
-            # Render limit_box
-            if p_box:
-                x1, x2, y1, y2 = s.limit_box
-                cam_center = (ccx, ccy)
-                pg.draw.line(screen, GREEN, self.get_position((x1, y1), cam_center, zf), 
-                            self.get_position((x1, y2), cam_center, zf), width=1)
-                pg.draw.line(screen, GREEN, self.get_position((x2, y1), cam_center, zf), 
-                            self.get_position((x2, y2), cam_center, zf), width=1)
-                pg.draw.line(screen, GREEN, self.get_position((x1, y1), cam_center, zf), 
-                            self.get_position((x2, y1), cam_center, zf), width=1)
-                pg.draw.line(screen, GREEN, self.get_position((x1, y2), cam_center, zf), 
-                            self.get_position((x2, y2), cam_center, zf), width=1)
-            for i in range(len(s.positions)-1, -1, -1):
-                if self.distance2p(s.positions[i], pos_v) >= BODY_INTERVAL*(s.radius/SNAKE_RADIUS_MIN):
-                    pos_v = s.positions[i]
-                    ps = self.get_position(s.positions[i], (ccx, ccy), zf)
-                    ps = self.vibrate_pos(ps, factor=8*(s.speed-SPEED_NORMAL))
-                    if is_in_screen(ps):
-                        pg.draw.circle(screen, s.color, ps, get_distance(s.radius), 0)
-        
-        # Print names of the snakes
-        if p_names:
-            font = pg.font.Font(None, 15)
-            for s_id in self.snakes:
-                text = font.render(f"{s_id}", True, WHITE)
-                screen.blit(text, self.get_position(self.snakes[s_id].positions[-1], (ccx, ccy), zf))
-
-        # Render the edges of the map
-        Line_width = 10
-        if math.floor(ccx-SCREEN_WIDTH*zf/2) == 0:
-            pg.draw.line(screen, RED, (0, 0), (0, SCREEN_HEIGHT-1), width=Line_width)
-        if math.floor(ccy-SCREEN_HEIGHT*zf/2) == 0:
-            pg.draw.line(screen, RED, (0, 0), (SCREEN_WIDTH-1, 0), width=Line_width)
-        if math.ceil(ccx+SCREEN_WIDTH*zf/2) == MAP_WIDTH:
-            pg.draw.line(screen, RED, (SCREEN_WIDTH-1, 0), (SCREEN_WIDTH-1, SCREEN_HEIGHT-1), width=Line_width)
-        if math.ceil(ccy+SCREEN_HEIGHT*zf/2) == MAP_HEIGHT:
-            pg.draw.line(screen, RED, (0, SCREEN_HEIGHT-1), (SCREEN_WIDTH-1, SCREEN_HEIGHT-1), width=Line_width)
-
     def snake_is_on_screen(self, snake_id, cam_center, zf):
         """ Decide if I can see a snake on my screen """
         # "Snake" box
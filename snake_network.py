@@ -61,9 +61,12 @@ class SnakeNetwork():
             raw_data += packet
         return raw_data, msg_type
 
-    def send_game_snapshot(self, conn, game_snapshot, *, lock_print):
-        """ Send game state to a single player"""
-        raw_data = pickle.dumps(game_snapshot)
+    def encode_snapshot(self, game_snapshot):
+        """ Encode game state, once for every client that gets the same snapshot """
+        return pickle.dumps(game_snapshot)
+
+    def send_raw_snapshot(self, conn, raw_data, *, lock_print):
+        """ Send an encoded game state to a single player """
         if not self.send_msg(conn, raw_data, MSG_TYPE_SNAKEGAME, lock_print=lock_print):
             with lock_print:
                 print(f"Connection interrupted while sending game snapshot.")
@@ -79,6 +82,24 @@ class SnakeNetwork():
             return False
         return True
 
+    def send_token(self, conn, token, *, lock_print):
+        """ Send player their resume token """
+        raw_data = token.encode()
+        if not self.send_msg(conn, raw_data, MSG_TYPE_TOKEN, lock_print=lock_print):
+            with lock_print:
+                print(f"Connection interrupted while sending token.")
+            return False
+        return True
+
+    def send_server_full(self, conn, retry_after, *, lock_print):
+        """ Tell a client that they cannot join now and should retry after some seconds """
+        raw_data = struct.pack('!f', retry_after)
+        if not self.send_msg(conn, raw_data, MSG_TYPE_SERVER_FULL, lock_print=lock_print):
+            with lock_print:
+                print(f"Connection interrupted while sending server full notice.")
+            return False
+        return True
+
     def send_death_notice(self, conn, *, lock_print):
         """ Send a message to notice player that they died """
         if not self.send_msg(conn, b"", MSG_TYPE_NOTICE, lock_print=lock_print):
@@ -96,6 +117,24 @@ class SnakeNetwork():
             return False
         return True
     
+    def send_resume(self, conn, token, *, lock_print):
+        """ Send resume request (passkey followed by the resume token) """
+        raw_data = PASSKEY.encode('utf-8') + token.encode()
+        if not self.send_msg(conn, raw_data, MSG_TYPE_RESUME, lock_print=lock_print):
+            with lock_print:
+                print(f"Connection interrupted while sending resume request.")
+            return False
+        return True
+    
+    def send_spectate(self, conn, target, *, lock_print):
+        """ Send spectate request (passkey followed by the snake ID to follow, empty for a free camera) """
+        raw_data = PASSKEY.encode('utf-8') + target.encode()
+        if not self.send_msg(conn, raw_data, MSG_TYPE_SPECTATE, lock_print=lock_print):
+            with lock_print:
+                print(f"Connection interrupted while sending spectate request.")
+            return False
+        return True
+    
     def send_input(self, conn, direction, speed, *, lock_print):
         """ Send input message """
         raw_data = struct.pack("ff", direction, speed)
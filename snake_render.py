@@ -0,0 +1,283 @@
+"""
+snake_render.py
+
+Rendering of the game: caches for the surfaces, drawing a SnakeGame and presenting frames.
+The game logic does not depend on this module (nor on pygame).
+
+Github: https://github.com/neilc24/slither24
+Author: Neil (GitHub: neilc24)
+"""
+
+import pygame as pg
+import math
+from collections import OrderedDict
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from snake_game import SnakeGame
+from config import *
+
+class SpriteCache:
+    def __init__ (self, max_size=SPRITE_CACHE_SIZE):
+        # Bounded LRU cache of pre-rendered surfaces: self.sprites = {key:Surface}
+        self.sprites = OrderedDict()
+        self.max_size = max_size
+        # self.fonts = {size:Font}
+        self.fonts = {}
+
+    def __str__ (self):
+        return f"<SpriteCache sprites={len(self.sprites)}, fonts={len(self.fonts)}>"
+
+    def lookup(self, key):
+        """ Return a cached surface and mark it as recently used, or None """
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+        return sprite
+
+    def store(self, key, sprite):
+        """ Cache a surface, evicting the least recently used ones when full """
+        self.sprites[key] = sprite
+        while len(self.sprites) > self.max_size:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def get_font(self, size):
+        """ Return the default font of the given size """
+        if not size in self.fonts:
+            self.fonts[size] = pg.font.Font(None, size)
+        return self.fonts[size]
+
+    def get_circle(self, color, radius):
+        """
+        Return (sprite, offset) of a filled circle. Radius is quantized to SPRITE_RADIUS_STEP.
+        Blit the sprite at (x-offset, y-offset) to center it on (x, y).
+        """
+        q = round(radius/SPRITE_RADIUS_STEP)
+        key = ("circle", tuple(color), q)
+        sprite = self.lookup(key)
+        if sprite is None:
+            r = q*SPRITE_RADIUS_STEP
+            size = 2*math.ceil(r)+1
+            sprite = pg.Surface((size, size), pg.SRCALPHA)
+            pg.draw.circle(sprite, color, (size//2, size//2), r, 0)
+            if pg.display.get_surface() is not None:
+                sprite = sprite.convert_alpha()
+            self.store(key, sprite)
+        return sprite, sprite.get_width()//2
+
+    def get_text(self, text, size, color):
+        """ Return a rendered text surface """
+        key = ("text", text, size, tuple(color))
+        sprite = self.lookup(key)
+        if sprite is None:
+            sprite = self.store(key, self.get_font(size).render(text, True, color))
+        return sprite
+
+# Shared by every renderer in the process
+sprite_cache = SpriteCache()
+
+class BodySampleCache:
+    def __init__ (self):
+        # Points picked along the body of each snake, reused until the snake moves: self.bodies = {snake_id:(key, points)}
+        self.bodies = {}
+
+    def __str__ (self):
+        return f"<BodySampleCache bodies={len(self.bodies)}>"
+
+    def get(self, snake_id, snake, spacing):
+        """ Return sample_body() of a snake, only walking the body again when it has changed """
+        positions = snake.positions
+        key = (spacing, len(positions), positions[0], positions[-1])
+        cached = self.bodies.get(snake_id)
+        if cached is None or cached[0] != key:
+            cached = self.bodies[snake_id] = (key, sample_body(positions, spacing))
+        return cached[1]
+
+    def keep(self, snake_ids):
+        """ Forget the snakes that are not in snake_ids """
+        self.bodies = {s_id: self.bodies[s_id] for s_id in snake_ids if s_id in self.bodies}
+
+# Shared by every renderer in the process
+body_cache = BodySampleCache()
+
+def get_positions(positions, cam_center, zf, scale=1):
+    """ Batched SnakeGame.get_position(), vectorized when NumPy is available """
+    k = scale/zf
+    ox, oy = scale*SCREEN_WIDTH/2-cam_center[0]*k, scale*SCREEN_HEIGHT/2-cam_center[1]*k
+    if np is not None and len(positions) >= NUMPY_BATCH_MIN:
+        screen_pos = np.rint(np.asarray(positions, dtype=np.float64)*k+(ox, oy)).astype(np.int64)
+        return screen_pos.tolist()
+    return [(round(x*k+ox), round(y*k+oy)) for x, y in positions]
+
+def sample_body(positions, spacing):
+    """
+    Return points every spacing along the body (measured along the body, head first),
+    interpolated between the stored points, plus the end of the tail
+    """
+    x0, y0 = positions[-1]
+    samples = [(x0, y0)]
+    need = spacing # Distance left to the next sample
+    for x1, y1 in reversed(positions):
+        seg = math.hypot(x1-x0, y1-y0)
+        while seg >= need:
+            t = need/seg
+            x0, y0 = x0+(x1-x0)*t, y0+(y1-y0)*t
+            samples.append((x0, y0))
+            seg -= need
+            need = spacing
+        need -= seg
+        x0, y0 = x1, y1
+    if need < spacing:
+        samples.append((x0, y0))
+    return samples
+
+def render_game(game:SnakeGame, screen, head_pos, zf, *, p_names=True, p_box=False, dirty=None):
+    """
+    Render the map of a game, the head of the given snake placed at the center.
+    Camera zooms out when the snake gets bigger.
+    The screen may be smaller than SCREEN_WIDTH x SCREEN_HEIGHT (scaled rendering).
+    If a list is given as dirty, the rectangles drawn on are appended to it.
+    """
+    sw, sh = screen.get_size()
+    scale = sw/SCREEN_WIDTH
+    # Draw a batch of (surface, dest) and collect the dirty rectangles
+    def blits(batch):
+        if dirty is None:
+            screen.blits(batch, doreturn=False)
+        else:
+            dirty.extend(screen.blits(batch))
+    def draw(rect):
+        if dirty is not None:
+            dirty.append(rect)
+
+    # Get screen distances baded on map distances
+    get_distance = lambda d: (d*scale/zf)
+
+    # Decide if a dot is in the screen
+    is_in_screen = lambda pos: (pos[0] >= 0 and pos[1] >= 0 and pos[0] <= sw and pos[1] <= sh)
+
+    ccx, ccy = game.get_cam_center(head_pos, zf)
+    # Render food (only the food the camera can see)
+    food = game.food
+    visible_food = food.query_rect(*game.get_cam_rect((ccx, ccy), zf, FOOD_RADIUS_AVE*2))
+    positions = get_positions([food.position(h) for h in visible_food], (ccx, ccy), zf, scale)
+    batch = []
+    for h, pos in zip(visible_food, positions):
+        sprite, offset = sprite_cache.get_circle(food.color(h), food.radii[h]*scale)
+        batch.append((sprite, (pos[0]-offset, pos[1]-offset)))
+    blits(batch)
+
+    # Render snakes
+    cx1, cx2, cy1, cy2 = game.get_cam_rect((ccx, ccy), zf)
+    visible_ids = []
+    for s_id, s in game.snakes.items():
+        # Skip the whole snake if its limit_box is off the screen
+        x1, x2, y1, y2 = s.limit_box
+        if x2+s.radius < cx1 or x1-s.radius > cx2 or y2+s.radius < cy1 or y1-s.radius > cy2:
+            continue
+        visible_ids.append(s_id)
+        # Render limit_box
+        if p_box:
+            p1, p2, p3, p4 = get_positions([(x1, y1), (x1, y2), (x2, y1), (x2, y2)], (ccx, ccy), zf, scale)
+            draw(pg.draw.line(screen, GREEN, p1, p2, width=1))
+            draw(pg.draw.line(screen, GREEN, p3, p4, width=1))
+            draw(pg.draw.line(screen, GREEN, p1, p3, width=1))
+            draw(pg.draw.line(screen, GREEN, p2, p4, width=1))
+        # Level of detail: draw the body at a fixed distance along it (not every stored point).
+        # Zoomed out far, or small on the screen, a snake is only a simplified outline:
+        # a thick polyline through sparse joints, rounded by a circle on each joint
+        radius = get_distance(s.radius)
+        if zf >= LOD_OUTLINE_ZF or radius < LOD_OUTLINE_RADIUS:
+            points = get_positions(body_cache.get(s_id, s, LOD_OUTLINE_SPACING*s.radius), (ccx, ccy), zf, scale)
+            if len(points) > 1:
+                draw(pg.draw.lines(screen, s.color, False, points, width=max(1, round(2*radius))))
+            sprite, offset = sprite_cache.get_circle(s.color, radius)
+            blits([(sprite, (ps[0]-offset, ps[1]-offset)) for ps in points if is_in_screen(ps)])
+            continue
+        # Otherwise circles get sparser as the camera zooms out. Boosting spreads the stored points, so
+        # the spacing is measured along the body and capped to keep the circles overlapping.
+        spacing = min(BODY_INTERVAL*(s.radius/SNAKE_RADIUS_MIN)*min(max(zf, 1), LOD_SPACING_SCALE_MAX),
+                      LOD_SPACING_MAX*s.radius)
+        points = get_positions(body_cache.get(s_id, s, spacing), (ccx, ccy), zf, scale)
+        sprite, offset = sprite_cache.get_circle(s.color, radius)
+        if s.speed > SPEED_NORMAL:
+            points = [game.vibrate_pos(ps, factor=8*scale*(s.speed-SPEED_NORMAL)) for ps in points]
+        blits([(sprite, (ps[0]-offset, ps[1]-offset)) for ps in points if is_in_screen(ps)])
+    
+    body_cache.keep(visible_ids)
+
+    # Print names of the snakes
+    if p_names:
+        font_size = max(8, round(15*scale))
+        blits([(sprite_cache.get_text(f"{s_id}", font_size, WHITE), 
+                game.get_position(game.snakes[s_id].positions[-1], (ccx, ccy), zf, scale)) 
+               for s_id in visible_ids])
+
+    # Render the edges of the map
+    Line_width = max(1, round(10*scale))
+    if math.floor(ccx-SCREEN_WIDTH*zf/2) == 0:
+        draw(pg.draw.line(screen, RED, (0, 0), (0, sh-1), width=Line_width))
+    if math.floor(ccy-SCREEN_HEIGHT*zf/2) == 0:
+        draw(pg.draw.line(screen, RED, (0, 0), (sw-1, 0), width=Line_width))
+    if math.ceil(ccx+SCREEN_WIDTH*zf/2) == MAP_WIDTH:
+        draw(pg.draw.line(screen, RED, (sw-1, 0), (sw-1, sh-1), width=Line_width))
+    if math.ceil(ccy+SCREEN_HEIGHT*zf/2) == MAP_HEIGHT:
+        draw(pg.draw.line(screen, RED, (0, sh-1), (sw-1, sh-1), width=Line_width))
+
+class FramePresenter:
+    """
+    Put rendered frames on the display.
+    With render_scale < 1 the world is rendered to a smaller offscreen surface and scaled up,
+    the HUD is drawn on top at full resolution.
+    With dirty_rects, only the changed rectangles are pushed while the camera stands still.
+    """
+    def __init__ (self, screen, *, render_scale=RENDER_SCALE, dirty_rects=DIRTY_RECTS):
+        self.screen = screen
+        self.scale = render_scale
+        if render_scale < 1:
+            size = (max(1, round(SCREEN_WIDTH*render_scale)), max(1, round(SCREEN_HEIGHT*render_scale)))
+            self.world = pg.Surface(size).convert()
+        else:
+            self.world = screen
+        self.dirty_rects = dirty_rects
+        self.dirty = [] if dirty_rects else None # Rectangles drawn on in the current frame
+        self.last_dirty = []
+        self.last_view = None
+
+    def begin_frame(self):
+        """ Clear the world surface and return it for rendering """
+        self.world.fill(BLACK)
+        if self.dirty_rects:
+            self.dirty = []
+        return self.world
+
+    def end_world(self):
+        """ Scale the world surface up to the screen once the world has been rendered """
+        if self.world is self.screen:
+            return
+        pg.transform.scale(self.world, self.screen.get_size(), self.screen)
+        if self.dirty_rects:
+            k = 1/self.scale
+            self.dirty = [pg.Rect(math.floor(r.x*k), math.floor(r.y*k), math.ceil(r.w*k)+1, math.ceil(r.h*k)+1) 
+                          for r in self.dirty]
+
+    def add_hud(self, rect):
+        """ Mark a rectangle drawn by the HUD as dirty """
+        if self.dirty_rects:
+            self.dirty.append(rect)
+
+    def present(self, view):
+        """
+        Show the frame. view identifies the camera (e.g. (cam_center, zf)):
+        if it did not change since the last frame, only dirty rectangles are updated.
+        """
+        if self.dirty_rects and view == self.last_view and len(self.dirty)+len(self.last_dirty) <= DIRTY_RECTS_MAX:
+            pg.display.update(self.last_dirty+self.dirty)
+        else:
+            pg.display.flip()
+        self.last_view = view
+        if self.dirty_rects:
+            self.last_dirty = self.dirty